@@ -15,19 +15,48 @@
 # ----------------------
 import os
 import sys
-from zipfile import ZipFile
 import numpy as np
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
 import lxml
 import re
+import threading
+from functools import partial
+
+from utils.sim import read_sim_chunks, aggregate_sim, aggregate_sim_parallel, collapse_sim, default_cube, sim_columns, im_causes
+from utils.icd import compile_icd_lists
+from utils.fetch import fetch_all
+from utils.scheduler import Scheduler
+from utils.tabnet import parse_tabnet, tabnet_query, tabnet_long, batch_years
+from utils.cache import year_ttl
+from utils.storage import save_table
+from utils.manifest import pending_years, write_partition, mark_failed, read_partitions
 
 # Main directories
 # ----------------------
 
 raw_folder = 'raw_data/'
 clean_folder = 'clean_data/'
+partition_folder = clean_folder + 'partitions/'
+
+# clean tables are saved as typed parquet files (utils/storage.py); True also writes a csv copy
+csv_export = True
+
+# Scraping options
+# ----------------------
+
+# responses from DATASUS are cached here, so re-runs don't download closed years again
+cache_folder = raw_folder + 'cache/'
+
+# True: use only the cache, no network (e.g. outside Brazil, where the websites might not be accessible)
+offline = False
+
+# number of years (one .dbf file each) packed in a single TabNet request
+years_per_request = 10
+
+# DATASUS servers get slower when hammered: requests per host start at 2 and adapt up to 5,
+# failed requests are retried up to 4 times (utils/scheduler.py)
+scheduler = Scheduler(max_per_host = 5, start = 2, retries = 4)
 
 # 1. Infant mortality micro data
 # =================================================================
@@ -40,97 +69,24 @@ clean_folder = 'clean_data/'
 # input
 # -----------------------------------------------------------------
 
-file = raw_folder + 'sim_microdata.zip'
-with ZipFile(file, 'r') as zipObj:
-   # Extract all the contents of zip file in different directory
-   zipObj.extractall(raw_folder)
-
-
-file = raw_folder + 'sim_microdata.csv'
-df = pd.read_csv(file,
-                 sep = ',',
-                 encoding = 'latin1',
-                 low_memory = False)
+# The csv is read straight out of the zip file, keeping only the four variables I need,
+# in chunks of 'chunksize' deaths. Each chunk is collapsed to the municipality-year level
+# and added to a running aggregate, so the full micro data is never held in memory.
 
-# selecting, renaming, and sorting
-selected_variables = ['mun_res','ano','capcid_cau','cid_cau']
-df = df.filter(selected_variables)
-df = df.rename(columns={'mun_res':'mun_code',
-                        'ano':'year',
-                        'capcid_cau':'icd_chapter',
-                        'cid_cau':'icd'})
-df = df.sort_values(by = ['mun_code','year'])
+sim_file = raw_folder + 'sim_microdata.zip'
+chunksize = 500000
 
-print(df.head())
+# The chunks can also be counted in parallel: the csv is cut into blocks of 'block_size' bytes,
+# which are parsed and collapsed by 'sim_workers' processes (None: one per core; 1: serial reading
+# in chunks as above). The result is the same either way.
 
-# Assessing the main causes of infant death in the baseline year of 2000
-# -----------------------------------------------------------------
-print(df["icd_chapter"][df["year"]==2000].value_counts())
+sim_workers = None
+block_size = 64 * 2 ** 20
 
 
 # Aggregating data at the municipality-year level
 # -----------------------------------------------------------------
 
-# 1. Overall infant deaths
-
-df['im'] = 1
-
-# 2. Deaths by cause of death
-
-# Perinatal
-df['im_perinat'] = 0
-df.loc[df['icd_chapter']=='Perinatal period conditions','im_perinat'] = 1
-
-# Congenital
-df['im_cong'] = 0
-df.loc[df['icd_chapter']=='Congenital malformations','im_cong'] = 1
-
-# Ill-defined
-df['im_illdef'] = 0
-df.loc[df['icd_chapter']=='Not well defined','im_illdef'] = 1
-
-# Infectious
-df['im_infec'] = 0
-df.loc[df['icd_chapter']=='Infectious and parasitic diseases','im_infec'] = 1
-
-# Respiratory
-df['im_resp'] = 0
-df.loc[df['icd_chapter']=='Respiratory system diseases','im_resp'] = 1
-
-# Endocrine
-df['im_endoc'] = 0
-df.loc[df['icd_chapter']=='Endocrine/nutrit./metabolic diseases','im_endoc'] = 1
-
-# External
-df['im_exter'] = 0
-df.loc[df['icd_chapter']=='External causes','im_exter'] = 1
-
-# Nervous
-df['im_nerv'] = 0
-df.loc[df['icd_chapter']=='Nervous system diseases','im_nerv'] = 1
-
-# Circulatory
-df['im_circ'] = 0
-df.loc[df['icd_chapter']=='Circulatory system diseases','im_circ'] = 1
-
-# Blood
-df['im_blood'] = 0
-df.loc[df['icd_chapter']=='Blood diseases','im_blood'] = 1
-
-# Digestive
-df['im_digest'] = 0
-df.loc[df['icd_chapter']=='Digestive system diseases','im_digest'] = 1
-
-# Eye
-df['im_eye'] = 0
-df.loc[df['icd_chapter']=='Eye/ear/skin/musculosk./genitourinary system','im_eye'] = 1
-
-# Neoplasms
-df['im_neop'] = 0
-df.loc[df['icd_chapter']=='Neoplasms','im_neop'] = 1
-
-
-
 # Amenable to Primary Care (Alfradique, 2009) - https://www.scielo.br/j/csp/a/y5n975h7b3yW6ybnk6hJwft/abstract/?lang=pt
 
 apc_icd = ["A361" ,"A362" ,"A369" ,"A370",
@@ -188,33 +144,69 @@ apc_icd = ["A361" ,"A362" ,"A369" ,"A370",
 "K921" ,"K922" ,"A500" ,"A501" ,"A502",
 "A504" ,"A505" ,"A509" ,"A350"]
 
-df['im_apc'] = 0
-df.loc[df['icd'].isin(apc_icd),'im_apc'] = 1
 
-# collapsing
+# ICD code lists counted as death variables. A 3-character code covers its whole category
+# (e.g. "A33" also matches "A330"). Other lists can be added here as new variables.
 
-cols = list(df.columns)
-imvars = [s for s in cols if "im" in s]
-dict = dict.fromkeys(imvars,'sum')
+icd_lists = {'im_apc': apc_icd}
 
-df_sim = df.groupby(['mun_code','year']).agg(dict).reset_index()
-df_sim['im_napc']  = df_sim['im'] - df_sim['im_apc']
+icd_index = compile_icd_lists(icd_lists)
 
-print(df_sim.head())
 
+# Death counts to compute, as cubes of grouping keys by count measures (see the spec in utils/sim.py).
+# All cubes are counted in the same pass over the micro data and each is saved as a clean table.
 
-# Exporting
-# -----------------------------------------------------------------
+# df_sim, by municipality and year:
+# 1. Overall infant deaths ('im')
+# 2. Deaths by cause of death: one variable per ICD chapter, as listed in 'im_causes' (utils/sim.py)
+# 3. Deaths by ICD code list: one variable per list in 'icd_lists'
 
-output_file = clean_folder + 'df_sim.csv'
-df_sim.to_csv(output_file, index=False)
+sim_spec = {'df_sim': default_cube(im_causes, icd_lists)}
 
+# Other cubes need their csv columns to be read too, e.g. neonatal and post-neonatal deaths by
+# municipality, year and sex, with the age at death in days in the column 'idade_dias':
+#
+# sim_read = dict(sim_columns, idade_dias = 'age_days', sexo = 'sex')
+# sim_spec['df_sim_age'] = {'keys': ['mun_code', 'year', 'sex',
+#                                    {'name': 'age', 'column': 'age_days', 'bins': [0, 28, 365], 'right': False,
+#                                     'labels': ['neonatal', 'post_neonatal']}],
+#                           'measures': {'im': {}}}
 
+sim_read = sim_columns
+
+collapse = partial(collapse_sim, spec = sim_spec, icd_index = icd_index)
+
+
+def import_sim():
+
+    # collapsing chunk by chunk
+
+    if sim_workers == 1:
+        cubes = aggregate_sim(read_sim_chunks(sim_file, chunksize = chunksize, columns = sim_read), collapse)
+    else:
+        cubes = aggregate_sim_parallel(sim_file, collapse, workers = sim_workers, block_size = block_size, columns = sim_read)
+
+    df_sim = cubes['df_sim']
+    df_sim['im_napc']  = df_sim['im'] - df_sim['im_apc']
+
+    print(df_sim.head())
+
+
+    # Assessing the main causes of infant death in the baseline year of 2000
+    # -----------------------------------------------------------------
+    imvars = [s for s in df_sim.columns if s.startswith('im_')]
+    print(df_sim.loc[df_sim['year']==2000, imvars].sum().sort_values(ascending = False))
+
+
+    # Exporting
+    # -----------------------------------------------------------------
+
+    save_table(df_sim, clean_folder, 'df_sim', csv = csv_export)
+
+    for name, df in cubes.items():
+        if name != 'df_sim':
+            save_table(df, clean_folder, name, csv = csv_export)
 
-# Deleting unzipped file
-# -----------------------------------------------------------------
-file_delete = raw_folder + 'sim_microdata.csv'
-os.remove(file_delete)
 
 
 # 2. Birth data
@@ -233,23 +225,34 @@ os.remove(file_delete)
 
 
 
-# Scraping function 
+# Scraping functions
 # -----------------------------------------------------------------
 
 
-def sinasc_scrape(year):
-    text = '_____ scraping birth records by municipality for the year of ' + str(year) + ' _____ '
+# The scraping is split in two: 'sinasc_request' builds the POST request for a batch of years
+# and 'sinasc_parse' turns the returned HTML (one column per year) into a data frame. All
+# batches are requested concurrently with 'fetch_all' (utils/fetch.py), going through the
+# response cache.
+
+def sinasc_request(years):
+    text = '_____ scraping birth records by municipality for the years of ' + str(years[0]) + '-' + str(years[-1]) + ' _____ '
     print(text)
     
     
     # POST request
     # ---------------------------
     
-    #  extracting year format for POST request data
-    year_html = str(year)[2:4]
+    #  one file per year, with the year format for POST request data
+    arquivos = ['nvbr' + str(year)[2:4] + '.dbf' for year in years]
     
-    # post request parameters
-    data = 'Linha=Munic%EDpio&Coluna=--N%E3o-Ativa--&Incremento=Nascim_p%2Fresid.m%E3e&Arquivos=nvbr' + year_html + '.dbf&pesqmes1=Digite+o+texto+e+ache+f%E1cil&SMunic%EDpio=TODAS_AS_CATEGORIAS__&pesqmes2=Digite+o+texto+e+ache+f%E1cil&SCapital=TODAS_AS_CATEGORIAS__&pesqmes3=Digite+o+texto+e+ache+f%E1cil&SRegi%E3o_de_Sa%FAde_%28CIR%29=TODAS_AS_CATEGORIAS__&pesqmes4=Digite+o+texto+e+ache+f%E1cil&SMacrorregi%E3o_de_Sa%FAde=TODAS_AS_CATEGORIAS__&pesqmes5=Digite+o+texto+e+ache+f%E1cil&SMicrorregi%E3o_IBGE=TODAS_AS_CATEGORIAS__&pesqmes6=Digite+o+texto+e+ache+f%E1cil&SRegi%E3o_Metropolitana_-_RIDE=TODAS_AS_CATEGORIAS__&pesqmes7=Digite+o+texto+e+ache+f%E1cil&STerrit%F3rio_da_Cidadania=TODAS_AS_CATEGORIAS__&pesqmes8=Digite+o+texto+e+ache+f%E1cil&SMesorregi%E3o_PNDR=TODAS_AS_CATEGORIAS__&SAmaz%F4nia_Legal=TODAS_AS_CATEGORIAS__&SSemi%E1rido=TODAS_AS_CATEGORIAS__&SFaixa_de_Fronteira=TODAS_AS_CATEGORIAS__&SZona_de_Fronteira=TODAS_AS_CATEGORIAS__&SMunic%EDpio_de_extrema_pobreza=TODAS_AS_CATEGORIAS__&SLocal_ocorr%EAncia=TODAS_AS_CATEGORIAS__&pesqmes15=Digite+o+texto+e+ache+f%E1cil&SIdade_da_m%E3e=TODAS_AS_CATEGORIAS__&pesqmes16=Digite+o+texto+e+ache+f%E1cil&SInstru%E7%E3o_da_m%E3e=TODAS_AS_CATEGORIAS__&SEstado_civil_m%E3e=TODAS_AS_CATEGORIAS__&SDura%E7%E3o_gesta%E7%E3o=TODAS_AS_CATEGORIAS__&STipo_de_gravidez=TODAS_AS_CATEGORIAS__&pesqmes20=Digite+o+texto+e+ache+f%E1cil&SGrupos_de_Robson=TODAS_AS_CATEGORIAS__&SAdeq_quant_pr%E9-natal*=TODAS_AS_CATEGORIAS__&STipo_de_parto=TODAS_AS_CATEGORIAS__&SConsult_pr%E9-natal=TODAS_AS_CATEGORIAS__&SSexo=TODAS_AS_CATEGORIAS__&SCor%2Fra%E7a=TODAS_AS_CATEGORIAS__&SApgar_1%BA_minuto=TODAS_AS_CATEGORIAS__&SApgar_5%BA_minuto=TODAS_AS_CATEGORIAS__&SPeso_ao_nascer=TODAS_AS_CATEGORIAS__&SAnomalia_cong%EAnita=TODAS_AS_CATEGORIAS__&pesqmes30=Digite+o+texto+e+ache+f%E1cil&STipo_anomal_cong%EAn=TODAS_AS_CATEGORIAS__&formato=table&mostre=Mostra'
+    # post request parameters: years as columns
+    filters = 'pesqmes1=Digite+o+texto+e+ache+f%E1cil&SMunic%EDpio=TODAS_AS_CATEGORIAS__&pesqmes2=Digite+o+texto+e+ache+f%E1cil&SCapital=TODAS_AS_CATEGORIAS__&pesqmes3=Digite+o+texto+e+ache+f%E1cil&SRegi%E3o_de_Sa%FAde_%28CIR%29=TODAS_AS_CATEGORIAS__&pesqmes4=Digite+o+texto+e+ache+f%E1cil&SMacrorregi%E3o_de_Sa%FAde=TODAS_AS_CATEGORIAS__&pesqmes5=Digite+o+texto+e+ache+f%E1cil&SMicrorregi%E3o_IBGE=TODAS_AS_CATEGORIAS__&pesqmes6=Digite+o+texto+e+ache+f%E1cil&SRegi%E3o_Metropolitana_-_RIDE=TODAS_AS_CATEGORIAS__&pesqmes7=Digite+o+texto+e+ache+f%E1cil&STerrit%F3rio_da_Cidadania=TODAS_AS_CATEGORIAS__&pesqmes8=Digite+o+texto+e+ache+f%E1cil&SMesorregi%E3o_PNDR=TODAS_AS_CATEGORIAS__&SAmaz%F4nia_Legal=TODAS_AS_CATEGORIAS__&SSemi%E1rido=TODAS_AS_CATEGORIAS__&SFaixa_de_Fronteira=TODAS_AS_CATEGORIAS__&SZona_de_Fronteira=TODAS_AS_CATEGORIAS__&SMunic%EDpio_de_extrema_pobreza=TODAS_AS_CATEGORIAS__&SLocal_ocorr%EAncia=TODAS_AS_CATEGORIAS__&pesqmes15=Digite+o+texto+e+ache+f%E1cil&SIdade_da_m%E3e=TODAS_AS_CATEGORIAS__&pesqmes16=Digite+o+texto+e+ache+f%E1cil&SInstru%E7%E3o_da_m%E3e=TODAS_AS_CATEGORIAS__&SEstado_civil_m%E3e=TODAS_AS_CATEGORIAS__&SDura%E7%E3o_gesta%E7%E3o=TODAS_AS_CATEGORIAS__&STipo_de_gravidez=TODAS_AS_CATEGORIAS__&pesqmes20=Digite+o+texto+e+ache+f%E1cil&SGrupos_de_Robson=TODAS_AS_CATEGORIAS__&SAdeq_quant_pr%E9-natal*=TODAS_AS_CATEGORIAS__&STipo_de_parto=TODAS_AS_CATEGORIAS__&SConsult_pr%E9-natal=TODAS_AS_CATEGORIAS__&SSexo=TODAS_AS_CATEGORIAS__&SCor%2Fra%E7a=TODAS_AS_CATEGORIAS__&SApgar_1%BA_minuto=TODAS_AS_CATEGORIAS__&SApgar_5%BA_minuto=TODAS_AS_CATEGORIAS__&SPeso_ao_nascer=TODAS_AS_CATEGORIAS__&SAnomalia_cong%EAnita=TODAS_AS_CATEGORIAS__&pesqmes30=Digite+o+texto+e+ache+f%E1cil&STipo_anomal_cong%EAn=TODAS_AS_CATEGORIAS__&formato=table&mostre=Mostra'
+
+    data = tabnet_query(linha = 'Munic%EDpio',
+                        coluna = 'Ano_do_nascimento',
+                        incrementos = ['Nascim_p%2Fresid.m%E3e'],
+                        arquivos = arquivos,
+                        filters = filters)
     
     headers = {
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
@@ -266,92 +269,68 @@ def sinasc_scrape(year):
         }
     
     # request
-    response = requests.post(
-        'http://tabnet.datasus.gov.br/cgi/tabcgi.exe?sinasc/cnv/nvbr.def',
-        headers=headers,
-        data=data,
-        verify=False,
-        timeout = 20
-    )
-    
-    
-    # Extracting HTML table elements
-    # ---------------------------
-    
-    soup = BeautifulSoup(response.text, 'lxml')
+    url = 'http://tabnet.datasus.gov.br/cgi/tabcgi.exe?sinasc/cnv/nvbr.def'
 
-    # table data
-    tabdados = soup.select(".tabdados tbody tr td")
-    tabdados = list(map(lambda node: node.get_text().strip(), tabdados))
+    label = 'sinasc ' + str(years[0]) + '-' + str(years[-1])
 
-    # table columns names
-    col_tabdados = soup.select(".tabdados tr th")
-    col_tabdados = list(map(lambda node: node.get_text().strip(), col_tabdados))
+    return {'url': url, 'data': data, 'headers': headers, 'ttl': year_ttl(max(years)), 'label': label}
 
 
-    # defining the number of rows and columns
-    len_tabdados = len(tabdados)
-    len_col_tabdados = len(col_tabdados)
+def sinasc_parse(html, years):
 
-    nrow = int(len_tabdados/len_col_tabdados)
-    ncol = int(len_col_tabdados)
+    # Extracting HTML table elements
+    # ---------------------------
 
-    # transforming into arrays and reshaping
-    df = np.array(tabdados).reshape(nrow,ncol)
+    # one row per municipality: code (our database id), name, and one column per year,
+    # already converted from portuguese to english format ('Total' row and column are not used)
+    df = parse_tabnet(html)
 
-    # converting to pandas df
-    df = pd.DataFrame(df,
-                      columns = ['municipality','births'])
 
-    
     # Data cleaning
     # ---------------------------
-    
-    # removes firts row containing the sum of all rows
-    df = df.drop(index=0)
 
-    # spliting municipalities' codes (our database id) from names 
-    df.insert(0,'mun_code',pd.to_numeric(df.municipality.str[0:6], errors = 'coerce', downcast = 'integer'))
-    df.drop(columns = 'municipality', axis = 1, inplace = True)
+    # from one column per year to one row per municipality-year
+    df = tabnet_long(df, 'births', years)
 
-    # droping non numeric codes
-    df = df.dropna()
+    return df
 
-    # converting births to numeric
-    df['births'] = df['births'].str.replace('.','', regex = True)
-    df['births'] = pd.to_numeric(df.births, errors = 'coerce')
-    df["births"] = df["births"].replace(np.nan, 0)
 
+# Running functions for 2000-2019 and appending all
+# -----------------------------------------------------------------
 
-    # adding year
-    df.insert(0,'year', year)
-    
-    
-    return df
+def import_births():
 
+    # Each year is saved to its own partition as soon as its batch arrives (utils/manifest.py),
+    # so only years that are missing, failed or stale are requested again in a re-run.
 
-# Loop to run function for 2000-2019 and append all
-# -----------------------------------------------------------------
-for year in range(2000,2020,1):
-    
-    df = sinasc_scrape(year=year)
-    
+    years = list(range(2000,2020,1))
+    batches = batch_years(pending_years(partition_folder, 'sinasc', years), years_per_request)
 
-    # Appending
-    
-    if year == 2000:
-        df_births = df
-    else:
-        df_births = pd.concat([df_births, df])
 
-df_births = df_births.astype(int)
+    def save_births(i, html):
+        df = sinasc_parse(html, batches[i])
+        for year in batches[i]:
+            write_partition(partition_folder, 'sinasc', year, df[df['year']==year], ttl = year_ttl(year))
 
+    def fail_births(i, error):
+        for year in batches[i]:
+            mark_failed(partition_folder, 'sinasc', year, error)
+
+
+    fetch_all([sinasc_request(batch) for batch in batches], scheduler = scheduler, cache_folder = cache_folder, offline = offline,
+              on_result = save_births, on_error = fail_births)
+
+    df_births = read_partitions(partition_folder, 'sinasc', years)
+
+    df_births = df_births.astype(int)
 
-# Exporting
-# -----------------------------------------------------------------
 
-output_file = clean_folder + 'df_births.csv'
-df_births.to_csv(output_file, index=False)
+    # Exporting
+    # -----------------------------------------------------------------
+
+    save_table(df_births, clean_folder, 'df_births', csv = csv_export)
+
+    export_fetch_stats()
 
 
 
@@ -375,19 +354,25 @@ df_births.to_csv(output_file, index=False)
 # Scraping function for spending
 # -----------------------------------------------------------------
 
-def siops_scrape_spend(year):
-    text = '_____ scraping public health spending per capita by municipality for the year of ' + str(year) + '_____ '
+def siops_request_spend(years):
+    text = '_____ scraping public health spending per capita by municipality for the years of ' + str(years[0]) + '-' + str(years[-1]) + '_____ '
     print(text)
 
 
     # POST request
     # ---------------------------
 
-    #  extracting year format for POST request data
-    year_html = str(year)[2:4]
+    #  one file per year, with the year format for POST request data
+    arquivos = ['indmun' + str(year)[2:4] + '.dbf' for year in years]
+
+    # post request parameters: years as columns
+    filters = 'SUF=TODAS_AS_CATEGORIAS__&SCapitais=TODAS_AS_CATEGORIAS__&SMunic-BR=TODAS_AS_CATEGORIAS__&SRegi%E3o=TODAS_AS_CATEGORIAS__&SSele%E7%E3o_Capitais=TODAS_AS_CATEGORIAS__&SFaixa_Pop=TODAS_AS_CATEGORIAS__&formato=table&mostre=Mostra'
 
-    # post request parameters
-    data = 'Linha=Munic-BR&Coluna=Ano&Incremento=2.1_D.Total_Sa%FAde%2FHab&Arquivos=indmun'+ year_html + '.dbf&SUF=TODAS_AS_CATEGORIAS__&SCapitais=TODAS_AS_CATEGORIAS__&SMunic-BR=TODAS_AS_CATEGORIAS__&SRegi%E3o=TODAS_AS_CATEGORIAS__&SSele%E7%E3o_Capitais=TODAS_AS_CATEGORIAS__&SFaixa_Pop=TODAS_AS_CATEGORIAS__&formato=table&mostre=Mostra'
+    data = tabnet_query(linha = 'Munic-BR',
+                        coluna = 'Ano',
+                        incrementos = ['2.1_D.Total_Sa%FAde%2FHab'],
+                        arquivos = arquivos,
+                        filters = filters)
 
     headers = {
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
@@ -402,100 +387,35 @@ def siops_scrape_spend(year):
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36',
     }
     # request
-    response = requests.post(
-        'http://siops-asp.datasus.gov.br/CGI/tabcgi.exe?SIOPS/serhist/municipio/mIndicadores.def',
-        headers=headers,
-        data=data,
-        verify=False,
-        timeout = 20
-    )
-
-
-    # Extracting HTML table elements
-    # ---------------------------
-
-    soup = BeautifulSoup(response.text, 'lxml')
-
-    # table data
-    tabdados = soup.select("body tr td")
-    tabdados = list(map(lambda node: node.get_text().strip(), tabdados))
-    del tabdados [0:4]
-    del tabdados [-5:]
-
-
-    # table columns names
-    id_tabdados = soup.select("body tr th")
-    id_tabdados = list(map(lambda node: node.get_text().strip(), id_tabdados))
-
-    # defining the number of rows and columns
-    id_cols = id_tabdados[0:3]
-    id_rows = id_tabdados[3:]
-
-    nrow = int(len(id_rows))
-    ncol = int(len(id_cols))
-
-
-    # # transforming into arrays and reshaping
-    df = np.array(tabdados).reshape(nrow,ncol-1)
-
-
-    # converting to pandas df
-    df = pd.DataFrame(df,
-                      columns = ['pc_spend','total'])
-
-    # adding data id rows
-    df.insert(0,'municipality',id_rows)
-
-
-     # Data cleaning
-    # ---------------------------
-
-    # removes firts row containing the sum of all rows
-    df.drop(index=0, inplace = True)
-
-    # removes last column containing the sum of all cols
-    df.drop(columns = 'total', axis = 1, inplace = True)
-
-    # spliting municipalities' codes (our database id) from names 
-    df.insert(0,'mun_code',pd.to_numeric(df.municipality.str[0:6], errors = 'coerce', downcast = 'integer'))
-    df.drop(columns = 'municipality', axis = 1, inplace = True)
-
-    # droping non numeric codes
-    df = df.dropna()
-
-    # converting spending to numeric
-
-    df['pc_spend'] = df['pc_spend'].str.replace('.','', regex = True) # converting numbers from portuguese to english
-    df['pc_spend'] = df['pc_spend'].str.replace(',','.', regex = True) # converting numbers from portuguese to english
-    df['pc_spend'] = pd.to_numeric(df.pc_spend, errors = 'coerce')
-    df["pc_spend"] = df["pc_spend"].replace(np.nan, 0)
-
-
-    # adding year
-    df.insert(0,'year', year)
-    
-    return df
-
+    url = 'http://siops-asp.datasus.gov.br/CGI/tabcgi.exe?SIOPS/serhist/municipio/mIndicadores.def'
 
+    label = 'siops_spend ' + str(years[0]) + '-' + str(years[-1])
 
+    return {'url': url, 'data': data, 'headers': headers, 'ttl': year_ttl(max(years)), 'label': label}
 
 
 # Scraping function for population
 # -----------------------------------------------------------------
 
-def siops_scrape_pop(year):
-    text = '_____ scraping population by municipality for the year of ' + str(year) + '_____ '
+def siops_request_pop(years):
+    text = '_____ scraping population by municipality for the years of ' + str(years[0]) + '-' + str(years[-1]) + '_____ '
     print(text)
 
 
     # POST request
     # ---------------------------
 
-    #  extracting year format for POST request data
-    year_html = str(year)[2:4]
+    #  one file per year, with the year format for POST request data
+    arquivos = ['indmun' + str(year)[2:4] + '.dbf' for year in years]
+
+    # post request parameters: years as columns
+    filters = 'SUF=TODAS_AS_CATEGORIAS__&SCapitais=TODAS_AS_CATEGORIAS__&SMunic-BR=TODAS_AS_CATEGORIAS__&SRegi%E3o=TODAS_AS_CATEGORIAS__&SSele%E7%E3o_Capitais=TODAS_AS_CATEGORIAS__&SFaixa_Pop=TODAS_AS_CATEGORIAS__&formato=table&mostre=Mostra'
 
-    # post request parameters
-    data = 'Linha=Munic-BR&Coluna=Ano&Incremento=Popula%E7%E3o&Arquivos=indmun'+ year_html + '.dbf&SUF=TODAS_AS_CATEGORIAS__&SCapitais=TODAS_AS_CATEGORIAS__&SMunic-BR=TODAS_AS_CATEGORIAS__&SRegi%E3o=TODAS_AS_CATEGORIAS__&SSele%E7%E3o_Capitais=TODAS_AS_CATEGORIAS__&SFaixa_Pop=TODAS_AS_CATEGORIAS__&formato=table&mostre=Mostra'
+    data = tabnet_query(linha = 'Munic-BR',
+                        coluna = 'Ano',
+                        incrementos = ['Popula%E7%E3o'],
+                        arquivos = arquivos,
+                        filters = filters)
 
     headers = {
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
@@ -510,127 +430,111 @@ def siops_scrape_pop(year):
 	    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36',
     }
     # request
-    response = requests.post(
-        'http://siops-asp.datasus.gov.br/CGI/tabcgi.exe?SIOPS/serhist/municipio/mIndicadores.def',
-        headers=headers,
-        data=data,
-        verify=False,
-        timeout = 20
-    )
+    url = 'http://siops-asp.datasus.gov.br/CGI/tabcgi.exe?SIOPS/serhist/municipio/mIndicadores.def'
+
+    label = 'siops_pop ' + str(years[0]) + '-' + str(years[-1])
+
+    return {'url': url, 'data': data, 'headers': headers, 'ttl': year_ttl(max(years)), 'label': label}
 
 
+# Parsing function (spending and population)
+# -----------------------------------------------------------------
+
+def siops_parse(html, var, years):
+
     # Extracting HTML table elements
     # ---------------------------
 
-    soup = BeautifulSoup(response.text, 'lxml')
+    # one row per municipality: code (our database id), name, and one column per year,
+    # already converted from portuguese to english format ('Total' row and column are not used)
+    df = parse_tabnet(html)
 
-    # table data
-    tabdados = soup.select("body tr td")
-    tabdados = list(map(lambda node: node.get_text().strip(), tabdados))
-    del tabdados [0:4]
-    del tabdados [-3:]
 
+    # Data cleaning
+    # ---------------------------
 
-    # table columns names
-    id_tabdados = soup.select("body tr th")
-    id_tabdados = list(map(lambda node: node.get_text().strip(), id_tabdados))
+    # from one column per year to one row per municipality-year
+    df = tabnet_long(df, var, years)
 
-    # defining the number of rows and columns
-    id_cols = id_tabdados[0:3]
-    id_rows = id_tabdados[3:]
+    return df
 
-    nrow = int(len(id_rows))
-    ncol = int(len(id_cols))
 
+# Running functions for 2000-2019 and appending all (Spending and Population)
+# -----------------------------------------------------------------
 
-    # transforming into arrays and reshaping
-    df = np.array(tabdados).reshape(nrow,ncol-1)
+def import_siops():
 
+    # As for births, each indicator-year is saved to its own partition as soon as it arrives,
+    # and only the missing, failed or stale ones are requested.
+    # Both indicators come from the same host, so they are requested together.
 
-    # converting to pandas df
-    df = pd.DataFrame(df,
-                      columns = ['pop','total'])
+    years = list(range(2000,2020,1))
 
-    # adding data id rows
-    df.insert(0,'municipality',id_rows)
+    batches = [('siops_spend', 'pc_spend', batch) for batch in batch_years(pending_years(partition_folder, 'siops_spend', years), years_per_request)]
+    batches += [('siops_pop', 'pop', batch) for batch in batch_years(pending_years(partition_folder, 'siops_pop', years), years_per_request)]
 
+    reqs = [siops_request_spend(batch) if source == 'siops_spend' else siops_request_pop(batch) for source, _, batch in batches]
 
-     # Data cleaning
-    # ---------------------------
 
-    # removes firts row containing the sum of all rows
-    df.drop(index=0, inplace = True)
+    def save_siops(i, html):
+        source, var, batch = batches[i]
+        df = siops_parse(html, var, batch)
+        for year in batch:
+            write_partition(partition_folder, source, year, df[df['year']==year], ttl = year_ttl(year))
 
-    # removes last column containing the sum of all cols
-    df.drop(columns = 'total', axis = 1, inplace = True)
+    def fail_siops(i, error):
+        source, _, batch = batches[i]
+        for year in batch:
+            mark_failed(partition_folder, source, year, error)
 
-    # spliting municipalities' codes (our database id) from names 
-    df.insert(0,'mun_code',pd.to_numeric(df.municipality.str[0:6], errors = 'coerce', downcast = 'integer'))
-    df.drop(columns = 'municipality', axis = 1, inplace = True)
 
-    # droping non numeric codes
-    df = df.dropna()
+    fetch_all(reqs, scheduler = scheduler, cache_folder = cache_folder, offline = offline, on_result = save_siops, on_error = fail_siops)
 
-    # converting spending to numeric
 
-    df['pop'] = df['pop'].str.replace('.','', regex = True) # converting numbers from portuguese to english
-    df['pop'] = df['pop'].str.replace(',','.', regex = True) # converting numbers from portuguese to english
-    df['pop'] = df['pop'].astype(str).astype(int)
-    df["pop"] = df["pop"].replace(np.nan, 0)
+    # Spending
 
+    df_spend = read_partitions(partition_folder, 'siops_spend', years)
+        
+    df_spend = df_spend.astype(int)
 
-    # adding year
-    df.insert(0,'year', year)
-    
-    return df
+    print(df_spend.head())        
 
 
+    # Population
 
-# Loop to run function for 2000-2019 and append all (Spending)
-# -----------------------------------------------------------------
-for year in range(2000,2020,1):
-    
-    df = siops_scrape_spend(year=year)
-    
-    # Appending
-    # ---------------------------
-    
-    if year == 2000:
-        df_spend = df
-    else:
-        df_spend = pd.concat([df_spend, df])
+    df_pop = read_partitions(partition_folder, 'siops_pop', years)
         
-df_spend = df_spend.astype(int)
+    df_pop = df_pop.astype(int)   
 
-print(df_spend.head())        
 
+    # Exporting 
+    # -----------------------------------------------------------------
 
-# Loop to run function for 2000-2019 and append all (Population)
-# -----------------------------------------------------------------
-for year in range(2000,2020,1):
-    
-    df = siops_scrape_pop(year=year)
-    
-    # Appending
-    # ---------------------------
-    
-    if year == 2000:
-        df_pop = df
-    else:
-        df_pop = pd.concat([df_pop, df])
-        
-df_pop = df_pop.astype(int)   
+    save_table(df_spend, clean_folder, 'df_spend', csv = csv_export)
+
+
+    save_table(df_pop, clean_folder, 'df_pop', csv = csv_export)
 
 
-# Exporting 
+    export_fetch_stats()
+
+
+# Request timings (SINASC and SIOPS)
 # -----------------------------------------------------------------
 
-output_file = clean_folder + 'df_spend.csv'
-df_spend.to_csv(output_file, index=False)
+# Both scraping stages share the scheduler and export the timings of all requests made so far,
+# so the last one to finish leaves the complete file. They can run at the same time (threads of
+# run_pipeline.py), so the file is written under a lock, through a temporary file and a rename.
 
+fetch_stats_lock = threading.Lock()
 
-output_file = clean_folder + 'df_pop.csv'
-df_pop.to_csv(output_file, index=False)
+def export_fetch_stats():
+    print(scheduler.summary())
+
+    output_file = partition_folder + 'fetch_stats.csv'
+    with fetch_stats_lock:
+        scheduler.stats().to_csv(output_file + '.tmp', index=False)
+        os.replace(output_file + '.tmp', output_file)
 
 
 
@@ -638,36 +542,50 @@ df_pop.to_csv(output_file, index=False)
 # 4. Inflation data
 # =================================================================
 
-# When working with spending data it's important to adjust nominal
-# values to real values. I use IBGE's IPCA (Consumer Price Index) 
-# monthly variation to build an index.
+def import_ipca():
+
+    # When working with spending data it's important to adjust nominal
+    # values to real values. I use IBGE's IPCA (Consumer Price Index) 
+    # monthly variation to build an index.
 
-# http://www.ipeadata.gov.br/Default.aspx (go to )
+    # http://www.ipeadata.gov.br/Default.aspx (go to )
 
-file = raw_folder + 'ipca.csv'
+    file = raw_folder + 'ipca.csv'
 
-df_ipca = pd.read_csv(file,
-                    sep = ';')
+    df_ipca = pd.read_csv(file,
+                        sep = ';')
 
-# creating inflation index (2019) = 1 from monthly variation
+    # creating inflation index (2019) = 1 from monthly variation
 
-df_ipca['index'] = 1
-df_ipca['var_lead'] = df_ipca['IPCA'].shift(-1)/100 + 1
+    df_ipca['index'] = 1
+    df_ipca['var_lead'] = df_ipca['IPCA'].shift(-1)/100 + 1
 
-rows = len(df_ipca) - 2
-loc_index = df_ipca.columns.get_loc("index")
-loc_var_lead = df_ipca.columns.get_loc("var_lead")
+    rows = len(df_ipca) - 2
+    loc_index = df_ipca.columns.get_loc("index")
+    loc_var_lead = df_ipca.columns.get_loc("var_lead")
 
-for i in range(rows,-1,-1):
-    df_ipca.iloc[i,loc_index] = df_ipca.iloc[i+1,loc_index] / df_ipca.iloc[i,loc_var_lead]
+    for i in range(rows,-1,-1):
+        df_ipca.iloc[i,loc_index] = df_ipca.iloc[i+1,loc_index] / df_ipca.iloc[i,loc_var_lead]
 
-df_ipca.drop(columns = ['IPCA','var_lead'], axis = 1, inplace = True)
+    df_ipca.drop(columns = ['IPCA','var_lead'], axis = 1, inplace = True)
 
 
 
-# Exporting
+    # Exporting
 
-output_file = clean_folder + 'df_ipca.csv'
-df_ipca.to_csv(output_file, index=False)
+    save_table(df_ipca, clean_folder, 'df_ipca', csv = csv_export)
+
+
+
+# 5. Running all stages
+# =================================================================
 
+# Each of the sections above is a stage of the pipeline (import_sim, import_births,
+# import_siops, import_ipca). run_pipeline.py runs them in parallel and skips the ones that
+# are up to date; running this script runs all four, one after the other.
 
+if __name__ == '__main__':
+    import_sim()
+    import_births()
+    import_siops()
+    import_ipca()
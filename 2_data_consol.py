@@ -22,12 +22,43 @@ from bs4 import BeautifulSoup
 import lxml
 import re
 
+from utils.storage import load_table, save_table_part, table_file
+from utils.panel import panel_index, new_cube, clear, scatter, scatter_year, year_slice, cube_to_frame, previous_year, prefix_sums, window_sums
+from utils.incremental import slice_hashes, files_hash, changed_slices, load_state, save_state, same_shape
+from utils.rates import compute_rates, smoothed_rates
+from utils.mapped import save_mapped
+from utils.code_files import consol_code
+
 # Main directories
 # ----------------------
 
 raw_folder = 'raw_data/'
 clean_folder = 'clean_data/'
 
+# the final panel is saved as typed parquet files (utils/storage.py); True also writes df_final.csv
+csv_export = True
+
+# the panel is also always written to df_final.panel, a memory-mapped binary copy that opens
+# without parsing (utils/mapped.py); the plots and regressions read it
+
+# state of the last run, used to update only the years whose inputs changed (utils/incremental.py)
+state_folder = clean_folder + 'consol/'
+
+# True ignores the saved state and rebuilds the whole panel
+full_rebuild = False
+
+# Derived rates, besides the raw ones (each family adds one column per mortality count, 16):
+# empirical-Bayes rates (im..._rate_eb) are shrunk toward the rate of the municipality's state
+# ('estado') or region ('Region') in the same year; None leaves them out
+eb_level = None
+
+# True adds the rates over the births of the previous year (im..._rate_prev)
+prev_rates = False
+
+# lengths (in years) of the windows of pooled rates (im..._rate_3y, ...): deaths / births summed
+# over the last n years, e.g. [3, 5]; empty leaves them out
+rate_windows = []
+
 
 # 1. Creating a blank balanced panel of municipalities (#5570) by year (#20)
 # =================================================================
@@ -60,97 +91,126 @@ regions = regions.filter(['id_munic_6','Region','municipio','estado']).rename(co
 # balanced panel
 # ---------------------------------------------------- 
 
-# number of years
-n_years = len(list(range(2000,2020))) 
-
-# number of municipalities
-n_mun = len(mun_list['id_munic_6'])
+# The panel is held as a dense cube of municipalities x years x variables (utils/panel.py):
+# each municipality code is mapped to a row and each year to a column once, and every
+# source below is scattered into the cube instead of being merged to a data frame.
 
-# list of all municipalities x number of years
-mun_codes = mun_list['id_munic_6'].astype(int).tolist() * n_years
-mun_codes.sort()
+years = list(range(2000,2020))
 
-# list of all years x number of municipalities
-years = list(range(2000,2020)) * n_mun
+index = panel_index(mun_list['id_munic_6'].astype(int), years)
 
+# number of years and municipalities
+n_years = len(index['years'])
+n_mun = len(index['mun_codes'])
 
-df = pd.DataFrame.from_dict({'mun_code': mun_codes, 'year': years})
+# municipality-level columns, in the order of the panel rows
+regions = regions.set_index('mun_code').loc[index['mun_codes']].reset_index(drop = True)
 
 
-df = df.merge(regions, on = 'mun_code', how = 'left')
+# 2. Filling the balanced panel with all clean data
+# =================================================================
 
+df_sim = load_table(clean_folder, 'df_sim')
+df_births = load_table(clean_folder, 'df_births')
+df_spend = load_table(clean_folder, 'df_spend')
+df_pop = load_table(clean_folder, 'df_pop')
+df_ipca = load_table(clean_folder, 'df_ipca')
 
-# 2. Merging all clean data to the balanced panel
-# =================================================================
+sim_vars = [s for s in df_sim.columns if s not in ['mun_code','year']]
 
-# number of variables in the empty balanced panel
-nvar0 = len(df.columns) 
+variables = sim_vars + ['births','pc_spend','pop','index']
 
 
-# Mortality data
+# Changes since the last run
 # ---------------------------------------------------- 
 
-file = clean_folder + 'df_sim.csv'
-df_sim = pd.read_csv(file)
+# Each clean table is hashed by year and compared with the hashes saved by the last run
+# (utils/incremental.py): only the years that changed are filled again in the saved cube,
+# and only those years of the final panel are recomputed and rewritten below.
+
+sources = {'df_sim': df_sim,
+           'df_births': df_births,
+           'df_spend': df_spend,
+           'df_pop': df_pop,
+           'df_ipca': df_ipca}
+
+hashes = {name: slice_hashes(source) for name, source in sources.items()}
+
+# a change in the stage's code (the same files run_pipeline.py checks, utils/code_files.py) or in
+# the list of municipalities forces a full rebuild
+code = files_hash(consol_code + [raw_folder + 'municipios.csv'])
+
+cube, state = load_state(state_folder)
+
+if full_rebuild or not same_shape(state, index, variables, code) or not os.path.isdir('df_final'):
+    cube = new_cube(index, variables)
+    changed = {name: years for name in sources}
+else:
+    changed = {name: [y for y in changed_slices(state['hashes'].get(name, {}), hashes[name]) if y in years]
+               for name in sources}
 
+# a changed year of deaths or births also changes the pooled rates of the windows that include
+# it, and the rates of the next year over its births; the other sources change only their years
+reach = max(rate_windows + [2 if prev_rates else 1])
+counts_changed = set(changed['df_sim']) | set(changed['df_births'])
+years_out = set().union(*changed.values()) | set(y + k for y in counts_changed for k in range(reach))
+years_out = sorted(years_out & set(years))
 
-df = df.merge(df_sim, on = ['mun_code','year'], how = 'left')
+print('years to update: ' + str(years_out))
 
-nvar1 = len(df.columns) # number of variables after merging
+
+# Mortality data
+# ---------------------------------------------------- 
 
 # NOTE: If a municipality does not have any record of death for a specific year,
 # we won't find this municipality in the micro data for that year, but this does not
 # classify as missing.
-# For this reason, the 'nan' values observed after merging the mortality data
-# to the balanced panel are supposed to be 0.
+# For this reason, the 'nan' values observed after filling the panel with the mortality data
+# are supposed to be 0.
 
-df.iloc[:,nvar0:nvar1] = df.iloc[:,nvar0:nvar1].replace(np.nan, 0) # replacing nan with 0
+clear(cube, index, variables, sim_vars, changed['df_sim'], fill = 0) # 0 instead of nan
+scatter(cube, index, variables, df_sim[df_sim['year'].isin(changed['df_sim'])], sim_vars)
 
 
 # Birth records
 # ---------------------------------------------------- 
 
-file = clean_folder + 'df_births.csv'
-df_births = pd.read_csv(file)
-
-
-df = df.merge(df_births, on = ['mun_code','year'], how = 'left')
-nvar2 = len(df.columns) # number of variables after merging
-
 # NOTE: Similarly. in the scraped website, if a municipality does not have any record of death for
 # a specific year, the table generated won't show that municipality.
-# For this reason, the 'nan' values observed after merging the mortality data
-# to the balanced panel are supposed to be 0
+# For this reason, the 'nan' values observed after filling the panel with the birth data
+# are supposed to be 0
 
-df.iloc[:,nvar1:nvar2] = df.iloc[:,nvar1:nvar2].replace(np.nan, 0) # replacing nan with 0
+clear(cube, index, variables, ['births'], changed['df_births'], fill = 0) # 0 instead of nan
+scatter(cube, index, variables, df_births[df_births['year'].isin(changed['df_births'])], ['births'])
 
 
 # Spending data
 # ---------------------------------------------------- 
 
-file = clean_folder + 'df_spend.csv'
-df_spend = pd.read_csv(file)
-
-df = df.merge(df_spend, on = ['mun_code','year'], how = 'left')
+clear(cube, index, variables, ['pc_spend'], changed['df_spend'])
+scatter(cube, index, variables, df_spend[df_spend['year'].isin(changed['df_spend'])], ['pc_spend'])
 
 
 # Population data
 # ---------------------------------------------------- 
 
-file = clean_folder + 'df_pop.csv'
-df_pop = pd.read_csv(file)
+clear(cube, index, variables, ['pop'], changed['df_pop'])
+scatter(cube, index, variables, df_pop[df_pop['year'].isin(changed['df_pop'])], ['pop'])
+
 
-df = df.merge(df_pop, on = ['mun_code','year'], how = 'left')
+# Inflation data (by year only)
+# ---------------------------------------------------- 
+
+clear(cube, index, variables, ['index'], changed['df_ipca'])
+scatter_year(cube, index, variables, df_ipca[df_ipca['year'].isin(changed['df_ipca'])], ['index'])
 
 
-# Merging inflation data
+# From the cube to a data frame (one row per municipality-year), for the years to update
 # ---------------------------------------------------- 
 
-file = clean_folder + 'df_ipca.csv'
-print(file)
-df_ipca = pd.read_csv(file)
+sub_cube, sub_index = year_slice(cube, index, years_out)
 
-df = df.merge(df_ipca, on = 'year', how = 'left')
+df = cube_to_frame(sub_cube, sub_index, variables, ids = regions)
 
 
 
@@ -158,13 +218,40 @@ df = df.merge(df_ipca, on = 'year', how = 'left')
 # 3. Calculating Infant Mortaltity Rates
 # =================================================================
 
-vars = list(df.columns)
-im_vars = [s for s in vars if "im" in s]
+# deaths per 1,000 live births, for all mortality counts at once (utils/rates.py);
+# municipality-years without births get a rate of 0
+
+im_vars = sim_vars
+
+df = pd.concat([df, compute_rates(df, im_vars, denominator = 'births', scale = 1000)], axis = 1)
 
-for v in im_vars:
-    v_rate = v + '_rate'
-    df[v_rate] = round(df[v] / df['births'] * 1000,2)
-    df.loc[df['births']==0,v_rate] = 0
+# smoothed rates (im..._rate_eb): rates of municipalities with few births are noisy (many zeros
+# and spikes), so each rate is shrunk toward the pooled rate of its state (or region) in the same
+# year, the more so the fewer births (empirical Bayes, Poisson-Gamma; utils/rates.py). Groups are
+# within years, so updating only some years gives the same result. Municipality-years without
+# births get the pooled rate.
+if eb_level is not None:
+    df = pd.concat([df, smoothed_rates(df, im_vars, denominator = 'births', by = (eb_level, 'year'), scale = 1000)], axis = 1)
+
+# rates over the births of the previous year (im..._rate_prev), which many infants who die in a
+# year were born in: the previous year is read along the year axis of the whole cube
+# (utils/panel.py), so it's right also when the years to update have gaps; the first year of the
+# panel has no previous births and gets nan.
+if prev_rates:
+    prev_births = previous_year(cube, index, variables, ['births'], years_out)[:, :, 0].ravel() # same order as df
+    df = pd.concat([df, compute_rates(df, im_vars, denominator = prev_births, scale = 1000, suffix = '_rate_prev')], axis = 1)
+
+# pooled rates (im..._rate_3y, ...): deaths and births summed over the last n years, for every
+# window length and mortality count at once. The sums come from prefix sums along the years of
+# the whole cube (utils/panel.py), so each window costs one subtraction; the first n - 1 years
+# of the panel have no complete window and get nan.
+if rate_windows:
+    prefix = prefix_sums(cube, variables, im_vars + ['births'])
+
+for window in rate_windows:
+    sums = year_slice(window_sums(prefix, window), index, years_out)[0]
+    df_window = cube_to_frame(sums, sub_index, im_vars + ['births'])
+    df = pd.concat([df, compute_rates(df_window, im_vars, denominator = 'births', scale = 1000, suffix = '_rate_' + str(window) + 'y')], axis = 1)
 
 
 # 4. Deflating spending data (2019 R$)
@@ -180,9 +267,25 @@ print(df.info())
 print('\n')
 print(df.head())
 
-output_file = 'df_final.csv'
-df.to_csv(output_file, index=False)
+# the final panel is saved with one part per year (df_final/<year>.parquet), so only the
+# years that changed are rewritten
+for year in years_out:
+    save_table_part(df[df['year'] == year], '', 'df_final', year)
+
+# the mapped and csv copies are full exports of the panel
+mapped_missing = not os.path.exists(table_file('', 'df_final', '.panel'))
 
+if years_out or mapped_missing:
+    df_full = load_table('', 'df_final')
 
+    save_mapped(df_full, '', 'df_final')
 
+    if csv_export and years_out:
+        df_full.to_csv(table_file('', 'df_final', '.csv'), index = False)
 
+# the state is saved last: if anything above fails, the next run updates the same years again
+save_state(state_folder, cube, {'mun_codes': index['mun_codes'].tolist(),
+                                'years': index['years'].tolist(),
+                                'variables': variables,
+                                'code': code,
+                                'hashes': hashes})
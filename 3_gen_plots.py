@@ -25,62 +25,132 @@ import plotly.express as px
 import plotly.offline as py
 import plotly.graph_objects as go
 
+from utils.storage import cached_table
+from utils.mapped import load_mapped
+from utils.code_files import rollups_code
+from utils.aggregate import rollups
+from utils.changes import panel_change
+from utils.figures import figure, write_figures
+
 
 # Raw data directory
 # ----------------------
 
 graphs_folder = 'graphs/'
 
+# Rendering
+# ----------------------
 
+# The figures are built and written in parallel processes (utils/figures.py), all cores if None.
+# Every page loads the same local copy of plotly.js (graphs/plotly.min.js), written once, instead
+# of embedding it; keep it next to the pages when moving them.
+plot_workers = None
 
-# 1. Loading final Data Frane
-# =================================================================
+# The municipality-level spending scatter (section 5) is drawn with WebGL (utils/figures.py). With
+# a number here, only that many municipalities (the most populous) are drawn individually, and the
+# others are binned by Region in a grid of about scatter_bins x scatter_bins cells; None draws all.
+scatter_top = None
+scatter_bins = 40
 
-df = pd.read_csv('df_final.csv')
+# Infant mortality rate of the municipality-level scatters (sections 4 and 5): 'im_rate' (raw) or
+# 'im_rate_eb', shrunk toward the state rate (needs eb_level in 2_data_consol.py), so that
+# municipalities with few births don't dominate them with zeros and spikes
+municipality_rate = 'im_rate'
 
 
-# 2. Time Series Plot: Brazil and Regions
+
+# 1. Loading data
 # =================================================================
 
-# collapsing IMR (weighted mean)
+# Each section below is a function returning the specs of its figures (utils/figures.py); they
+# are all rendered at the end. The data is loaded and the figures are prepared only when the
+# script is run (see the end), not when the rendering processes import it.
+
+
+# Rollups
 # -------------------------------------------------------
 
-wm = lambda x: np.average(x, weights=df.loc[x.index, "births"])
+# Brazil, Region and State by year: births-weighted means of every infant mortality rate and of
+# spending per capita, and sums of population and births (utils/aggregate.py), in one small table.
+# It is cached in df_agg.parquet and rebuilt only when the content of df_final or the code that
+# builds it (this script, utils/aggregate.py, ...: utils/code_files.py) changes.
+# The panel is read from its memory-mapped copy, df_final.panel (utils/mapped.py), written by
+# 2_data_consol.py: it opens in milliseconds, without parsing or copying the columns.
 
+levels = {'Brazil': ['year'],
+          'Region': ['year','Region'],
+          'State': ['estado','year','Region']}
 
-# Brazil
-df_br = df.groupby('year').agg(imr_total = ('im_rate',wm)).reset_index()
-df_br.insert(1,'Region','Brazil')
-df_br = df_br.rename(columns = {'imr_total':'Infant Mortality Rate'})
+def build_rollups():
+    df = load_mapped('', 'df_final')
+    df[['estado','Region']] = df[['estado','Region']].astype(object)
 
+    rates = [col for col in df.columns if col.startswith('im') and col.endswith('_rate')]
 
-# By Region
-df_region = df.groupby(['year','Region']).agg(imr_total = ('im_rate',wm)).reset_index()
-df_region = df_region.rename(columns = {'imr_total':'Infant Mortality Rate'})
+    return rollups(df, levels, weight = 'births',
+                   births = ('births','sum'),
+                   pop = ('pop','sum'),
+                   pc_spend = ('pc_spend','wmean'),
+                   **{rate: (rate,'wmean') for rate in rates})
 
+def load_rollups():
+    df_agg = cached_table('', 'df_agg', 'df_final.panel', build_rollups, code = rollups_code)
 
-df_plot = pd.concat([df_br, df_region])
+    # names are stored as categoricals; as plain labels, plotly keeps the same trace (color) order as before
+    df_agg[['estado','Region']] = df_agg[['estado','Region']].astype(object)
+    return df_agg
 
-# Plot
+
+# Municipality level
 # -------------------------------------------------------
 
-fig = px.line(df_plot,
-				x="year",
-				y="Infant Mortality Rate",
-				title='Recent Trends in Infant Mortality Rates',
-				color = 'Region',
-				line_dash_sequence = ['solid','dash'],
-				hover_data=["Region", "Infant Mortality Rate"])
+# only the columns used in the municipality-level plots are loaded
+columns = ['mun_code','year','municipio','Region','pop','pc_spend']
+
+def load_municipalities():
+    df = load_mapped('', 'df_final', columns = columns + [municipality_rate])
+    df = df.rename(columns = {municipality_rate: 'im_rate'})
+    df[['municipio','Region']] = df[['municipio','Region']].astype(object)
+    return df
+
+
+# 2. Time Series Plot: Brazil and Regions
+# =================================================================
+
+def plot_trends(df_agg):
+
+    # Brazil
+    df_br = df_agg.loc[df_agg['level']=='Brazil', ['year','im_rate']].reset_index(drop = True)
+    df_br.insert(1,'Region','Brazil')
+    df_br = df_br.rename(columns = {'im_rate':'Infant Mortality Rate'})
+
 
-fig.update_xaxes(dtick=1)
+    # By Region
+    df_region = df_agg.loc[df_agg['level']=='Region', ['year','Region','im_rate']].reset_index(drop = True)
+    df_region = df_region.rename(columns = {'im_rate':'Infant Mortality Rate'})
 
 
-# fig.update_traces(hovertemplate=None)
-# fig.update_layout(hovermode="x")
+    df_plot = pd.concat([df_br, df_region])
 
+    # Plot
+    # -------------------------------------------------------
 
-file = graphs_folder + '1_trends.html'
-fig.write_html(file)
+    file = graphs_folder + '1_trends.html'
+
+    fig = figure(file, 'line', df_plot,
+    				x="year",
+    				y="Infant Mortality Rate",
+    				title='Recent Trends in Infant Mortality Rates',
+    				color = 'Region',
+    				line_dash_sequence = ['solid','dash'],
+    				hover_data=["Region", "Infant Mortality Rate"],
+    				xaxes = dict(dtick=1))
+
+
+    # fig.update_traces(hovertemplate=None)
+    # fig.update_layout(hovermode="x")
+
+    return [fig]
 
 
 
@@ -88,44 +158,41 @@ fig.write_html(file)
 # # 3. Time Series Plot: By main causes of death
 # # =================================================================
 
-# # collapsing IMR (weighted mean)
-# # -------------------------------------------------------
+def plot_trends_cause(df_agg):
 
-# Main causes of death
-vars = ['im_perinat', 'im_cong','im_illdef','im_infec','im_resp']
+    # # collapsing IMR (weighted mean)
+    # # -------------------------------------------------------
 
-# df_causes = pd.melt(df, id_vars=['mun_code','year'], value_vars = vars, var_name='cause',value_name = "imr")
+    # Main causes of death
+    vars = ['im_perinat', 'im_cong','im_illdef','im_infec','im_resp']
 
+    # df_causes = pd.melt(df, id_vars=['mun_code','year'], value_vars = vars, var_name='cause',value_name = "imr")
 
-df_causes = df.groupby('year').agg(perinat = ('im_perinat_rate',wm),
-								   cong = ('im_cong_rate',wm),
-								   illdef = ('im_illdef_rate',wm),
-								   infec = ('im_infec_rate',wm),
-								   resp = ('im_resp_rate',wm)).reset_index()
 
-vars = ['perinat', 'cong','illdef','infec','resp']
-df_causes = pd.melt(df_causes, id_vars=['year'], value_vars = vars, var_name='cause',value_name = "imr")
+    df_causes = df_agg.loc[df_agg['level']=='Brazil', ['year'] + [v + '_rate' for v in vars]].reset_index(drop = True)
+    df_causes.columns = ['year','perinat','cong','illdef','infec','resp']
 
-df_causes.loc[df_causes['cause']=='perinat','cause'] = 'Perinatal'
-df_causes.loc[df_causes['cause']=='cong','cause'] = 'Congenital'
-df_causes.loc[df_causes['cause']=='illdef','cause'] = 'Ill-defined'
-df_causes.loc[df_causes['cause']=='infec','cause'] = 'Infectious'
-df_causes.loc[df_causes['cause']=='resp','cause'] = 'Respiratory'
+    vars = ['perinat', 'cong','illdef','infec','resp']
+    df_causes = pd.melt(df_causes, id_vars=['year'], value_vars = vars, var_name='cause',value_name = "imr")
 
-df_causes = df_causes.rename(columns = {'cause': 'Cause of Death','imr':'Infant Mortality Rate'})
+    df_causes.loc[df_causes['cause']=='perinat','cause'] = 'Perinatal'
+    df_causes.loc[df_causes['cause']=='cong','cause'] = 'Congenital'
+    df_causes.loc[df_causes['cause']=='illdef','cause'] = 'Ill-defined'
+    df_causes.loc[df_causes['cause']=='infec','cause'] = 'Infectious'
+    df_causes.loc[df_causes['cause']=='resp','cause'] = 'Respiratory'
 
+    df_causes = df_causes.rename(columns = {'cause': 'Cause of Death','imr':'Infant Mortality Rate'})
 
-# Plot
-# -------------------------------------------------------
-
-fig = px.line(df_causes, x="year", y="Infant Mortality Rate", title='Recent Trends in Infant Mortality Rates by Cause of Death in Brazil', color = 'Cause of Death')
-fig.update_xaxes(dtick=1)
 
+    # Plot
+    # -------------------------------------------------------
 
+    file = graphs_folder + '2_trends_cause.html'
 
+    fig = figure(file, 'line', df_causes, x="year", y="Infant Mortality Rate", title='Recent Trends in Infant Mortality Rates by Cause of Death in Brazil', color = 'Cause of Death',
+    	xaxes = dict(dtick=1))
 
-file = graphs_folder + '2_trends_cause.html'
-fig.write_html(file)
+    return [fig]
 
 
 
@@ -138,124 +205,136 @@ fig.write_html(file)
 # such as public healthcare. In this context, evaluating
 # convergence in infant mortality rates is very relevent.
 
+def plot_shifts(df, df_agg):
 
-# Municipality level
-# -------------------------------------------------------
+    # Municipality level
+    # -------------------------------------------------------
 
 
-# creating the variable shitfs in IMR
+    # creating the variable shitfs in IMR: change of each municipality between 2000 and 2019
+    # (utils/changes.py), matched by mun_code, whatever the order of the panel
 
-df_plot = df
-df_plot['Shifts in Infant Mortality Rate - 2000-2019'] =  df_plot['im_rate'].shift(-19) - df_plot['im_rate']
+    df_plot = df[df['year'] == 2000].set_index('mun_code')
+    df_plot['Shifts in Infant Mortality Rate - 2000-2019'] = panel_change(df, 'im_rate', 2000, 2019, by = 'mun_code')
 
-df_plot = df_plot[df_plot['year'] == 2000]
+    df_plot = df_plot.reset_index()
 
-df_plot = df_plot.filter(['mun_code','im_rate','Shifts in Infant Mortality Rate - 2000-2019','municipio','Region', 'pop'])
-df_plot = df_plot.rename(columns = {'im_rate': 'Infant Mortality Rate in 2000','municipio':'Municipality','pop':'Population'})
+    df_plot = df_plot.filter(['mun_code','im_rate','Shifts in Infant Mortality Rate - 2000-2019','municipio','Region', 'pop'])
+    df_plot = df_plot.rename(columns = {'im_rate': 'Infant Mortality Rate in 2000','municipio':'Municipality','pop':'Population'})
 
-df_plot = df_plot.dropna(axis=0)
+    df_plot = df_plot.dropna(axis=0)
 
-fig = px.scatter(df_plot, x="Infant Mortality Rate in 2000", y="Shifts in Infant Mortality Rate - 2000-2019",
-	title = 'Shifts in Infant Mortality Rate 2000-2019 and Infant Mortality Rate in 2000',
-	color="Region", size = 'Population',hover_name="Municipality",size_max=150, range_x=[0,200], range_y=[-200,200])
+    file = graphs_folder + '3_scatter_shifts.html'
 
+    fig_mun = figure(file, 'scatter', df_plot, x="Infant Mortality Rate in 2000", y="Shifts in Infant Mortality Rate - 2000-2019",
+    	title = 'Shifts in Infant Mortality Rate 2000-2019 and Infant Mortality Rate in 2000',
+    	color="Region", size = 'Population',hover_name="Municipality",size_max=150, range_x=[0,200], range_y=[-200,200])
 
-file = graphs_folder + '3_scatter_shifts.html'
-fig.write_html(file)
 
+    # State level
+    # -------------------------------------------------------
 
-# State level
-# -------------------------------------------------------
+    # state rollups (section 1)
+    df_state = df_agg.loc[df_agg['level']=='State', ['estado','year','Region','im_rate','pop']].reset_index(drop = True)
 
-# aggretating
-df_plot = df.dropna(axis=0)
-df_plot = df_plot.groupby(['estado','year','Region']).agg(imr = ('im_rate',wm),
-													 pop = ('pop','sum')).reset_index()
+    df_plot = df_state[df_state['year'] == 2000].set_index('estado')
+    df_plot = df_plot.rename(columns = {'im_rate': 'imr'})
 
 
 
-df_plot['Shifts in Infant Mortality Rate - 2000-2019'] =  df_plot['imr'].shift(-19) - df_plot['imr']
+    df_plot['Shifts in Infant Mortality Rate - 2000-2019'] = panel_change(df_state, 'im_rate', 2000, 2019, by = 'estado')
 
 
 
-df_plot = df_plot[df_plot['year'] == 2000]
+    df_plot = df_plot.reset_index()
 
-df_plot = df_plot.filter(['estado','imr','Shifts in Infant Mortality Rate - 2000-2019','municipio','Region', 'pop'])
-df_plot = df_plot.rename(columns = {'imr': 'Infant Mortality Rate in 2000','estado':'State','pop':'Population'})
+    df_plot = df_plot.filter(['estado','imr','Shifts in Infant Mortality Rate - 2000-2019','municipio','Region', 'pop'])
+    df_plot = df_plot.rename(columns = {'imr': 'Infant Mortality Rate in 2000','estado':'State','pop':'Population'})
 
-df_plot = df_plot.dropna(axis=0)
+    df_plot = df_plot.dropna(axis=0)
 
-fig = px.scatter(df_plot, x="Infant Mortality Rate in 2000", y="Shifts in Infant Mortality Rate - 2000-2019",
-	color="Region", size = 'Population',hover_name="State",size_max=50, range_x=[10,35], range_y=[-20,5])
+    file = graphs_folder + '4_scatter_shifts_st.html'
 
-fig.update_layout(
-    title=go.layout.Title(
-        text="Shifts in Infant Mortality Rate 2000-2019 and Infant Mortality Rate in 2000 <br><sup>Data plotted at the State level</sup>",
-        xref="paper",
-        x=0
-    ))
+    fig_st = figure(file, 'scatter', df_plot, x="Infant Mortality Rate in 2000", y="Shifts in Infant Mortality Rate - 2000-2019",
+    	color="Region", size = 'Population',hover_name="State",size_max=50, range_x=[10,35], range_y=[-20,5],
+    	layout = dict(
+    	    title=go.layout.Title(
+    	        text="Shifts in Infant Mortality Rate 2000-2019 and Infant Mortality Rate in 2000 <br><sup>Data plotted at the State level</sup>",
+    	        xref="paper",
+    	        x=0
+    	    )))
 
-file = graphs_folder + '4_scatter_shifts_st.html'
-fig.write_html(file)
+    return [fig_mun, fig_st]
 
 # # # 5. Scatter plot: Infant Mortality Rates vs Health Spending through time
 # # # =================================================================
 
-# municipality level
-# -------------------------------------------------------
+def plot_spending(df, df_agg):
 
-df_plot = df.filter(['mun_code','year','im_rate','municipio','Region','pop','pc_spend'])
-df_plot = df_plot.rename(columns = {'im_rate': 'Infant Mortality Rate','municipio':'Municipality','pop':'Population','pc_spend':'Public Health Spending per Capita (2019R$)'})
+    # municipality level
+    # -------------------------------------------------------
 
-df_plot = df_plot.dropna(axis=0)
+    df_plot = df.filter(['mun_code','year','im_rate','municipio','Region','pop','pc_spend'])
+    df_plot = df_plot.rename(columns = {'im_rate': 'Infant Mortality Rate','municipio':'Municipality','pop':'Population','pc_spend':'Public Health Spending per Capita (2019R$)'})
 
-fig = px.scatter(df_plot, x="Public Health Spending per Capita (2019R$)", y="Infant Mortality Rate",
-	animation_frame="year", animation_group="Municipality", color = 'Region',hover_name = 'Municipality',
-	size = 'Population',size_max = 100,range_x=[0,3000])
+    df_plot = df_plot.dropna(axis=0)
 
-fig.update_layout(
-    title=go.layout.Title(
-        text="The changing relationship between health spending and Infant Mortality. <br><sup>Data plotted at the Municipality level</sup>",
-        xref="paper",
-        x=0
-    ))
+    file = graphs_folder + '5_scatter_spending.html'
 
+    fig_mun = figure(file, 'animated_scatter_gl', df_plot, x="Public Health Spending per Capita (2019R$)", y="Infant Mortality Rate",
+    	animation_frame="year", animation_group="mun_code", color = 'Region',hover_name = 'Municipality',
+    	size = 'Population',size_max = 100,range_x=[0,3000], top = scatter_top, bins = scatter_bins,
+    	layout = dict(
+    	    title=go.layout.Title(
+    	        text="The changing relationship between health spending and Infant Mortality. <br><sup>Data plotted at the Municipality level</sup>",
+    	        xref="paper",
+    	        x=0
+    	    )))
 
-file = graphs_folder + '5_scatter_spending.html'
-fig.write_html(file)
 
 
+    # State level
+    # -------------------------------------------------------
+
+    # state rollups (section 1)
+    df_plot = df_agg.loc[df_agg['level']=='State', ['estado','year','Region','im_rate','pop','pc_spend']].reset_index(drop = True)
+    df_plot = df_plot.rename(columns = {'im_rate': 'imr'})
 
-# State level
-# -------------------------------------------------------
 
-# aggretating
-df_plot = df.dropna(axis=0)
-df_plot = df_plot.groupby(['estado','year','Region']).agg(imr = ('im_rate',wm),
-													 pop = ('pop','sum'),
-													 pc_spend = ('pc_spend',wm)).reset_index()
 
 
+    df_plot = df_plot.rename(columns = {'imr': 'Infant Mortality Rate','estado':'State','pop':'Population','pc_spend':'Public Health Spending per Capita (2019R$)'})
 
 
-df_plot = df_plot.rename(columns = {'imr': 'Infant Mortality Rate','estado':'State','pop':'Population','pc_spend':'Public Health Spending per Capita (2019R$)'})
+    df_plot.to_csv('teste.csv')
 
+    df_plot = df_plot.dropna(axis=0)
 
-df_plot.to_csv('teste.csv')
+    file = graphs_folder + '6_scatter_spending_st.html'
 
-df_plot = df_plot.dropna(axis=0)
+    fig_st = figure(file, 'scatter', df_plot, x="Public Health Spending per Capita (2019R$)", y="Infant Mortality Rate",
+    	animation_frame="year", animation_group="State", color = 'Region',hover_name = 'State',
+    	size = 'Population',size_max = 50,range_x=[0,1500], range_y=[0,50],
+    	layout = dict(
+    	    title=go.layout.Title(
+    	        text="The changing relationship between health spending and Infant Mortality. <br> <sup>Data plotted at the State level</sup>",
+    	        xref="paper",
+    	        x=0
+    	    )))
+
+    return [fig_mun, fig_st]
+
+
+# 6. Rendering
+# =================================================================
 
-fig = px.scatter(df_plot, x="Public Health Spending per Capita (2019R$)", y="Infant Mortality Rate",
-	animation_frame="year", animation_group="State", color = 'Region',hover_name = 'State',
-	size = 'Population',size_max = 50,range_x=[0,1500], range_y=[0,50])
+# The figures are prepared here and built and written by write_figures, in parallel processes.
+# Those processes import this script again (spawn), so everything runs under this guard.
 
-fig.update_layout(
-    title=go.layout.Title(
-        text="The changing relationship between health spending and Infant Mortality. <br> <sup>Data plotted at the State level</sup>",
-        xref="paper",
-        x=0
-    ))
+if __name__ == '__main__':
+    df_agg = load_rollups()
+    df = load_municipalities()
 
+    figures = plot_trends(df_agg) + plot_trends_cause(df_agg) + plot_shifts(df, df_agg) + plot_spending(df, df_agg)
 
-file = graphs_folder + '6_scatter_spending_st.html'
-fig.write_html(file)
\ No newline at end of file
+    write_figures(figures, graphs_folder, workers = plot_workers)
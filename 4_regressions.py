@@ -0,0 +1,67 @@
+#######################################################################################################
+#
+# This script relates infant mortality to public health spending: two-way fixed-effects regressions
+# (municipality and year) of every infant mortality rate on spending per capita, weighted by births,
+# with errors clustered by municipality (utils/fe.py).
+#
+#######################################################################################################
+
+
+# 0. Set-up
+# =================================================================
+
+# Libraries
+# ----------------------
+import pandas as pd
+
+from utils.mapped import open_mapped, load_mapped
+from utils.fe import fe_regressions
+
+# Main directories
+# ----------------------
+
+results_file = 'fe_results.csv'
+
+
+
+# 1. Loading data
+# =================================================================
+
+# infant mortality rates: all deaths and by cause (per 1000 births), from the columns of the
+# memory-mapped copy of the final panel (2_data_consol.py)
+columns = list(open_mapped('', 'df_final')['columns'])
+rates = [col for col in columns if col.startswith('im') and col.endswith('_rate')]
+
+# final panel, only the columns used here
+df = load_mapped('', 'df_final', columns = ['mun_code', 'year', 'births', 'pc_spend'] + rates)
+
+# spending in R$100 per capita (2019R$), so coefficients are per R$100
+df['pc_spend_100'] = df['pc_spend'] / 100
+
+
+
+# 2. Regressions
+# =================================================================
+
+# Specifications: regressors of each one; every specification runs all the rates in one call,
+# with municipality and year fixed effects, births weights and errors clustered by municipality
+
+specs = {'spending': ['pc_spend_100']}
+
+results = []
+for spec, regressors in specs.items():
+    df_spec = fe_regressions(df, rates, regressors, absorb = ('mun_code', 'year'), weight = 'births', cluster = 'mun_code')
+    df_spec.insert(0, 'spec', spec)
+    results.append(df_spec)
+
+results = pd.concat(results, ignore_index = True)
+
+
+
+# 3. Exporting
+# =================================================================
+
+pd.set_option('display.width', 200)
+print(results[['spec', 'outcome', 'variable', 'coef', 'se', 'p', 'nobs']])
+
+results.to_csv(results_file, index = False)
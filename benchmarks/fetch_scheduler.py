@@ -0,0 +1,113 @@
+#######################################################################################################
+#
+# Benchmark: adaptive scheduler (utils/scheduler.py) against a local stand-in for a DATASUS server
+#
+# The stand-in server gets slower as more requests run at once on it (like the TabNet CGI), and
+# answers 503 at random, more often when overloaded. The same requests are sent with the
+# adaptive scheduler and with a fixed high concurrency without retries.
+#
+# usage (from the project folder): python benchmarks/fetch_scheduler.py
+#
+#######################################################################################################
+
+import os
+import sys
+import time
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.fetch import fetch_all
+from utils.scheduler import Scheduler
+
+
+n_requests = 60
+port = 8766
+
+
+# Stand-in server
+# -----------------------------------------------------------------
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    base_latency = 0.05   # seconds per request when idle
+    free_slots = 3        # requests served at once without slowing down
+    slot_latency = 0.10   # extra seconds per request above free_slots
+    error_rate = 0.05     # share of 503 when not overloaded
+    overload_error = 0.15 # extra share of 503 per request above free_slots
+
+    active = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+
+        with StandInHandler.lock:
+            StandInHandler.active += 1
+            over = max(0, StandInHandler.active - self.free_slots)
+
+        time.sleep(self.base_latency + self.slot_latency * over)
+
+        with StandInHandler.lock:
+            StandInHandler.active -= 1
+
+        if random.random() < self.error_rate + self.overload_error * over:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        body = b'<html><body><table><tr><th>Munic</th><th>2000</th></tr></table></body></html>'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve():
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandInHandler)
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+
+# Running
+# -----------------------------------------------------------------
+
+def run(scheduler):
+    url = 'http://127.0.0.1:' + str(port) + '/cgi/tabcgi.exe'
+    reqs = [{'url': url, 'data': 'Arquivos=' + str(i), 'headers': {}, 'label': str(i)} for i in range(n_requests)]
+
+    t0 = time.time()
+    try:
+        fetch_all(reqs, scheduler = scheduler)
+        done = 'all done'
+    except Exception as e:
+        done = 'failed: ' + type(e).__name__
+    elapsed = time.time() - t0
+
+    stats = scheduler.stats()
+    failed = (stats['status'] >= 400).sum()
+
+    return elapsed, len(stats), failed, done
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    serve()
+
+    print(str(n_requests) + ' requests\n')
+    print('{:<26}{:>10}{:>10}{:>10}   {}'.format('', 'time (s)', 'attempts', 'errors', 'result'))
+
+    runs = [('fixed 10, no retries', Scheduler(max_per_host = 10, start = 10, retries = 0, slow_factor = float('inf'))),
+            ('adaptive (max 10)', Scheduler(max_per_host = 10, start = 2, retries = 6, backoff = 0.1))]
+
+    for name, scheduler in runs:
+        elapsed, attempts, failed, done = run(scheduler)
+        print('{:<26}{:>10.2f}{:>10}{:>10}   {}'.format(name, elapsed, attempts, failed, done))
+
+    print('')
+    print(runs[1][1].summary().to_string(index = False))
@@ -0,0 +1,53 @@
+#######################################################################################################
+#
+# Benchmark: loading the final panel from df_final.csv, from the parquet parts (utils/storage.py)
+# and from the memory-mapped copy df_final.panel (utils/mapped.py), all columns and only the ones
+# used by the municipality-level plots
+#
+# usage (from the project folder, after 2_data_consol.py): python benchmarks/mapped_panel.py
+#
+#######################################################################################################
+
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.storage import load_table, table_file
+from utils.mapped import open_mapped, load_mapped
+
+
+columns = ['mun_code', 'year', 'municipio', 'Region', 'pop', 'pc_spend', 'im_rate']
+
+
+def best(func, repeat = 5):
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        result = func()
+        times.append(time.time() - t0)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    loaders = {'csv, all columns': lambda: pd.read_csv(table_file('', 'df_final', '.csv')),
+               'parquet, all columns': lambda: load_table('', 'df_final'),
+               'parquet, 7 columns': lambda: load_table('', 'df_final', columns = columns),
+               'mapped, open': lambda: open_mapped('', 'df_final'),
+               'mapped, all columns': lambda: load_mapped('', 'df_final'),
+               'mapped, 7 columns': lambda: load_mapped('', 'df_final', columns = columns)}
+
+    reference = load_table('', 'df_final')
+    print(str(len(reference)) + ' rows, ' + str(len(reference.columns)) + ' columns\n')
+    print('{:<24}{:>12}'.format('', 'time (ms)'))
+
+    for name, load in loaders.items():
+        if name.startswith('csv') and not os.path.exists(table_file('', 'df_final', '.csv')):
+            continue
+        t, _ = best(load)
+        print('{:<24}{:>12.1f}'.format(name, t * 1000))
+
+    print('\nsame panel: ' + str(load_mapped('', 'df_final').equals(reference)))
@@ -0,0 +1,51 @@
+#######################################################################################################
+#
+# Benchmark: rendering the six figures of 3_gen_plots.py as before (one after the other, each page
+# embedding plotly.js) against utils/figures.py (pages sharing one local plotly.js, built in 1, 2,
+# 4, ... worker processes, up to the number of cores)
+#
+# usage (from the project folder, after 2_data_consol.py): python benchmarks/render_figures.py
+#
+#######################################################################################################
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.dag import load_script
+from utils.figures import build_figure, write_figures
+
+
+def folder_size(folder):
+    return sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+
+
+if __name__ == '__main__':
+    plots = load_script('3_gen_plots.py')
+
+    df_agg = plots.load_rollups()
+    df = plots.load_municipalities()
+    figures = plots.plot_trends(df_agg) + plots.plot_trends_cause(df_agg) + plots.plot_shifts(df, df_agg) + plots.plot_spending(df, df_agg)
+
+    print(str(len(figures)) + ' figures, ' + str(os.cpu_count()) + ' cores\n')
+    print('{:<26}{:>10}{:>12}'.format('', 'time (s)', 'size (MB)'))
+
+    with tempfile.TemporaryDirectory() as folder:
+        t0 = time.time()
+        for spec in figures:
+            build_figure(spec).write_html(os.path.join(folder, os.path.basename(spec['file'])))
+        print('{:<26}{:>10.2f}{:>12.1f}'.format('embedded, serial', time.time() - t0, folder_size(folder) / 2 ** 20))
+
+    workers = 1
+    while workers <= os.cpu_count():
+        with tempfile.TemporaryDirectory() as folder:
+            specs = [dict(spec, file = os.path.join(folder, os.path.basename(spec['file']))) for spec in figures]
+
+            t0 = time.time()
+            write_figures(specs, folder, workers = workers)
+            print('{:<26}{:>10.2f}{:>12.1f}'.format('shared, ' + str(workers) + ' workers', time.time() - t0, folder_size(folder) / 2 ** 20))
+
+        workers *= 2
@@ -0,0 +1,56 @@
+#######################################################################################################
+#
+# Benchmark: the municipality-level animated spending scatter of 3_gen_plots.py (section 5) with
+# px.scatter (svg, names and ids repeated in every frame) against animated_scatter_gl
+# (utils/figures.py: WebGL, names stored once, float32 frames), with and without level of detail
+#
+# For each version: page size (without plotly.js, which is shared), time to build and serialize
+# the figure, and time to parse its JSON back, a proxy for the browser's load time.
+#
+# usage (from the project folder, after 2_data_consol.py): python benchmarks/scatter_gl.py
+#
+#######################################################################################################
+
+import os
+import sys
+import json
+import time
+
+import plotly.express as px
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.dag import load_script
+from utils.figures import build_figure
+
+
+def best(func, repeat = 3):
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        result = func()
+        times.append(time.time() - t0)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    plots = load_script('3_gen_plots.py')
+
+    spec = plots.plot_spending(plots.load_municipalities(), plots.load_rollups())[0]
+    args = {k: v for k, v in spec['args'].items() if k not in ('top', 'bins')}
+    data = spec['data']
+
+    versions = {'px.scatter (svg)': lambda: px.scatter(data, **dict(args, animation_group = 'Municipality')),
+                'scattergl, all': lambda: build_figure(dict(spec, args = dict(spec['args'], top = None))),
+                'scattergl, top 1000': lambda: build_figure(dict(spec, args = dict(spec['args'], top = 1000))),
+                'scattergl, top 250': lambda: build_figure(dict(spec, args = dict(spec['args'], top = 250)))}
+
+    print(str(len(data)) + ' points, ' + str(data['year'].nunique()) + ' frames\n')
+    print('{:<22}{:>12}{:>12}{:>12}'.format('', 'page (MB)', 'build (s)', 'parse (s)'))
+
+    for name, build in versions.items():
+        t_build, page = best(lambda: build().to_html(include_plotlyjs = False))
+        payload = build().to_json()
+        t_parse, _ = best(lambda: json.loads(payload))
+
+        print('{:<22}{:>12.2f}{:>12.2f}{:>12.3f}'.format(name, len(page.encode('utf-8')) / 2 ** 20, t_build, t_parse))
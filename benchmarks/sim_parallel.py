@@ -0,0 +1,82 @@
+#######################################################################################################
+#
+# Benchmark: serial against process-parallel SIM aggregation (utils/sim.py)
+#
+# Builds a synthetic SIM zip file (random municipalities, years, chapters and ICD codes) and
+# aggregates it serially and with 1, 2, 4, ... worker processes, up to the number of cores.
+# Every parallel result is checked to be identical to the serial one.
+#
+# usage (from the project folder): python benchmarks/sim_parallel.py [number of deaths]
+#
+#######################################################################################################
+
+import os
+import sys
+import time
+import tempfile
+import zipfile
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.sim import read_sim_chunks, aggregate_sim, aggregate_sim_parallel, collapse_sim, default_cube, im_causes
+from utils.icd import compile_icd_lists
+
+
+n_deaths = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+block_size = 16 * 2 ** 20
+
+icd_codes = ['A33', 'A330', 'A09', 'P071', 'Q249', 'J189', 'E550', 'N390', 'R99', 'A371', 'J00', 'I10']
+icd_lists = {'im_apc': ['A33', 'A09', 'E550', 'N390', 'A371', 'J00', 'I10']}
+icd_index = compile_icd_lists(icd_lists)
+
+sim_spec = {'df_sim': default_cube(im_causes, icd_lists)}
+
+
+# Synthetic micro data
+# -----------------------------------------------------------------
+
+def make_sim(file):
+    rng = np.random.default_rng(0)
+    mun = pd.read_csv('raw_data/municipios.csv')['id_munic_6'].to_numpy()
+    chapters = list(im_causes.values()) + ['Pregnancy']
+
+    df = pd.DataFrame({'mun_res': rng.choice(mun, n_deaths),
+                       'ano': rng.integers(2000, 2020, n_deaths),
+                       'capcid_cau': rng.choice(chapters, n_deaths),
+                       'cid_cau': rng.choice(icd_codes, n_deaths),
+                       'other': 'x'})
+
+    with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('sim_microdata.csv', df.to_csv(index = False).encode('latin1'))
+
+
+# Running
+# -----------------------------------------------------------------
+
+if __name__ == '__main__':
+    collapse = partial(collapse_sim, spec = sim_spec, icd_index = icd_index)
+
+    with tempfile.TemporaryDirectory() as folder:
+        file = os.path.join(folder, 'sim_microdata.zip')
+        make_sim(file)
+
+        print(str(n_deaths) + ' deaths, ' + str(os.cpu_count()) + ' cores\n')
+        print('{:<14}{:>10}{:>10}   {}'.format('', 'time (s)', 'speed-up', 'same result'))
+
+        t0 = time.time()
+        serial = aggregate_sim(read_sim_chunks(file), collapse)['df_sim']
+        t_serial = time.time() - t0
+        print('{:<14}{:>10.2f}{:>10.2f}'.format('serial', t_serial, 1.0))
+
+        workers = 1
+        while workers <= os.cpu_count():
+            t0 = time.time()
+            df = aggregate_sim_parallel(file, collapse, workers = workers, block_size = block_size)['df_sim']
+            elapsed = time.time() - t0
+
+            print('{:<14}{:>10.2f}{:>10.2f}   {}'.format(str(workers) + ' workers', elapsed, t_serial / elapsed, df.equals(serial)))
+            workers *= 2
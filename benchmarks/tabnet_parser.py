@@ -0,0 +1,148 @@
+#######################################################################################################
+#
+# Benchmark: TabNet table parsing, BeautifulSoup CSS selection (old path) vs utils/tabnet.py
+#
+# Builds a SINASC-like response with one row per municipality in raw_data/municipios.csv (5,570)
+# and parses it with both paths. Each path runs in its own process, so memory is not mixed up
+# between them. Reported: best time of 5 runs, peak Python heap during one parse (tracemalloc) and
+# increase of the process max RSS over all runs (which also covers lxml's C allocations).
+#
+# usage (from the project folder): python benchmarks/tabnet_parser.py
+#
+#######################################################################################################
+
+import os
+import sys
+import time
+import resource
+import subprocess
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+raw_folder = 'raw_data/'
+n_runs = 5
+
+
+# Synthetic response
+# -----------------------------------------------------------------
+
+def br_format(x):
+    return f'{x:,}'.replace(',', '.')
+
+
+def make_response():
+    mun_list = pd.read_csv(raw_folder + 'municipios.csv')
+    births = np.random.default_rng(0).integers(0, 200000, len(mun_list))
+
+    rows = ''.join('<tr><td align="left">' + str(code) + ' ' + name + '</td><td align="right">' + br_format(int(b)) + '</td></tr>'
+                   for code, name, b in zip(mun_list['id_munic_6'], mun_list['municipio'], births))
+
+    html = ('<html><head><meta charset="iso-8859-1"></head><body>'
+            '<table class="tabdados"><thead><tr><th>Município</th><th>Nascim_p/resid.mãe</th></tr></thead>'
+            '<tbody><tr><td>Total</td><td>' + br_format(int(births.sum())) + '</td></tr>' + rows + '</tbody></table>'
+            '</body></html>')
+
+    return html.encode('latin1', errors = 'replace')
+
+
+# Old path (BeautifulSoup + CSS selection + reshape)
+# -----------------------------------------------------------------
+
+def parse_old(html):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'lxml')
+
+    tabdados = soup.select(".tabdados tbody tr td")
+    tabdados = list(map(lambda node: node.get_text().strip(), tabdados))
+
+    col_tabdados = soup.select(".tabdados tr th")
+    col_tabdados = list(map(lambda node: node.get_text().strip(), col_tabdados))
+
+    nrow = int(len(tabdados)/len(col_tabdados))
+    ncol = int(len(col_tabdados))
+
+    df = pd.DataFrame(np.array(tabdados).reshape(nrow,ncol), columns = ['municipality','births'])
+    df = df.drop(index=0)
+    df.insert(0,'mun_code',pd.to_numeric(df.municipality.str[0:6], errors = 'coerce', downcast = 'integer'))
+    df = df.drop(columns = 'municipality')
+    df = df.dropna()
+    df['births'] = pd.to_numeric(df['births'].str.replace('.','', regex = True), errors = 'coerce').fillna(0)
+
+    return df
+
+
+# New path
+# -----------------------------------------------------------------
+
+def parse_new(html):
+    from utils.tabnet import parse_tabnet
+
+    df = parse_tabnet(html)
+
+    return pd.DataFrame({'mun_code': df['code'], 'births': df.iloc[:,2].fillna(0)})
+
+
+# Running one path in this process
+# -----------------------------------------------------------------
+
+def run(path, file):
+    parse = {'old': parse_old, 'new': parse_new}[path]
+
+    with open(file, 'rb') as f:
+        html = f.read()
+
+    # baseline memory after imports, before parsing anything
+    import bs4
+    import utils.tabnet
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    tracemalloc.start()
+    df = parse(html)
+    heap = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del df
+
+    times = []
+    for _ in range(n_runs):
+        t0 = time.perf_counter()
+        df = parse(html)
+        times.append(time.perf_counter() - t0)
+        del df
+
+    rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in KB on Linux
+    print(path, min(times), heap / 2**20, (rss1 - rss0) / 1024)
+
+
+# Main
+# -----------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1:
+        run(sys.argv[1], sys.argv[2])
+
+    else:
+        html = make_response()
+        assert parse_old(html).reset_index(drop = True).astype(int).equals(parse_new(html).astype(int))
+
+        print('response size: ' + str(round(len(html) / 1024)) + ' KB, ' + str(len(parse_new(html))) + ' municipalities')
+        print('')
+        print('{:<6}{:>12}{:>18}{:>20}'.format('path', 'time (ms)', 'peak heap (MB)', 'max RSS +(MB)'))
+
+        # the response is handed to each process through a file, so building it doesn't count
+        with tempfile.NamedTemporaryFile(suffix = '.html', delete = False) as f:
+            f.write(html)
+
+        for path in ['old', 'new']:
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__), path, f.name]).decode().split()
+            print('{:<6}{:>12.1f}{:>18.1f}{:>20.1f}'.format(path, float(out[1]) * 1000, float(out[2]), float(out[3])))
+
+        os.remove(f.name)
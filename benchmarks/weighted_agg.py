@@ -0,0 +1,56 @@
+#######################################################################################################
+#
+# Benchmark: births-weighted means by Brazil, Region and State (utils/aggregate.py) against the
+# per-group lambda previously used in 3_gen_plots.py
+#
+# usage (from the project folder, after 2_data_consol.py): python benchmarks/weighted_agg.py
+#
+#######################################################################################################
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.storage import load_table
+from utils.aggregate import weighted_agg
+
+
+rates = ['im_rate', 'im_perinat_rate', 'im_cong_rate', 'im_illdef_rate', 'im_infec_rate', 'im_resp_rate']
+sets = [['year'], ['year', 'Region'], ['estado', 'year', 'Region']]
+
+
+def best(func, repeat = 3):
+    times = []
+    for _ in range(repeat):
+        t0 = time.time()
+        result = func()
+        times.append(time.time() - t0)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    df = load_table('', 'df_final', columns = ['year', 'Region', 'estado', 'births'] + rates)
+    df[['Region', 'estado']] = df[['Region', 'estado']].astype(object)
+
+    wm = lambda x: np.average(x, weights = df.loc[x.index, 'births'])
+
+    def lambdas():
+        return [df.groupby(s).agg(**{r: (r, wm) for r in rates}).reset_index() for s in sets]
+
+    def grouped_sums():
+        return weighted_agg(df, sets, weight = 'births', **{r: (r, 'wmean') for r in rates})
+
+    t_lambda, old = best(lambdas)
+    t_sums, new = best(grouped_sums)
+
+    diff = max(np.nanmax(np.abs(a[rates].to_numpy() - b[rates].to_numpy())) for a, b in zip(old, new))
+
+    print(str(len(df)) + ' rows, ' + str(len(rates)) + ' rates, ' + str(len(sets)) + ' grouping sets\n')
+    print('{:<26}{:>10}'.format('', 'time (s)'))
+    print('{:<26}{:>10.3f}'.format('per-group lambda', t_lambda))
+    print('{:<26}{:>10.3f}'.format('grouped sums', t_sums))
+    print('\nspeed-up: ' + str(round(t_lambda / t_sums, 1)) + 'x, largest difference: ' + str(diff))
@@ -0,0 +1,110 @@
+#######################################################################################################
+#
+# Runs the whole pipeline (1_data_import.py, 2_data_consol.py, 3_gen_plots.py and 4_regressions.py)
+# as a graph of stages with declared inputs and outputs (utils/dag.py).
+#
+# A stage is skipped when its code and input files are unchanged since its last successful run and
+# its outputs are still there. The four import stages do not depend on each other and run in
+# parallel; consolidation waits for all of them, and the plots and regressions wait for consolidation.
+#
+# usage: python run_pipeline.py [stage names to force]
+#
+#######################################################################################################
+
+
+# 0. Set-up
+# =================================================================
+
+# Libraries
+# ----------------------
+import os
+import sys
+import threading
+
+from utils.dag import stage, load_script, run_script, run_stages
+from utils.code_files import import_code, scrape_code, sim_code, consol_code, plots_code, regressions_code
+
+# Main directories
+# ----------------------
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+raw_folder = 'raw_data/'
+clean_folder = 'clean_data/'
+graphs_folder = 'graphs/'
+
+# hashes and times of the last runs
+state_file = clean_folder + 'pipeline.json'
+
+# scraped data is checked again after a week, as open years in the response cache (utils/cache.py)
+web_ttl = 7 * 24 * 3600
+
+
+# 1. Stages
+# =================================================================
+
+# Import stages are functions of 1_data_import.py; the script is loaded only when one of them
+# runs, so an up-to-date pipeline doesn't even import pandas.
+
+import_lock = threading.Lock()
+import_script = {}
+
+def import_stage(func):
+    def run():
+        with import_lock:
+            if 'module' not in import_script:
+                import_script['module'] = load_script('1_data_import.py')
+        getattr(import_script['module'], func)()
+    return run
+
+
+# code files of each stage: utils/code_files.py
+
+stages = [stage('sim', import_stage('import_sim'),
+                inputs = [raw_folder + 'sim_microdata.zip'],
+                outputs = [clean_folder + 'df_sim.parquet'],
+                code = sim_code),
+
+          stage('births', import_stage('import_births'),
+                outputs = [clean_folder + 'df_births.parquet'],
+                code = scrape_code,
+                ttl = web_ttl),
+
+          stage('siops', import_stage('import_siops'),
+                outputs = [clean_folder + 'df_spend.parquet', clean_folder + 'df_pop.parquet'],
+                code = scrape_code,
+                ttl = web_ttl),
+
+          stage('ipca', import_stage('import_ipca'),
+                inputs = [raw_folder + 'ipca.csv'],
+                outputs = [clean_folder + 'df_ipca.parquet'],
+                code = import_code),
+
+          stage('consol', run_script('2_data_consol.py'),
+                inputs = [clean_folder + t + '.parquet' for t in ['df_sim', 'df_births', 'df_spend', 'df_pop', 'df_ipca']] + [raw_folder + 'municipios.csv'],
+                outputs = ['df_final', 'df_final.panel'],
+                code = consol_code),
+
+          stage('plots', run_script('3_gen_plots.py'),
+                inputs = ['df_final.panel'],
+                outputs = [graphs_folder + f for f in ['1_trends.html', '2_trends_cause.html', '3_scatter_shifts.html',
+                                                       '4_scatter_shifts_st.html', '5_scatter_spending.html', '6_scatter_spending_st.html', 'plotly.min.js']],
+                code = plots_code),
+
+          stage('regressions', run_script('4_regressions.py'),
+                inputs = ['df_final.panel'],
+                outputs = ['fe_results.csv'],
+                code = regressions_code)]
+
+
+# 2. Running
+# =================================================================
+
+if __name__ == '__main__':
+    status = run_stages(stages, state_file, max_workers = 4, force = sys.argv[1:])
+
+    for name, s in status.items():
+        print('{:<14}{}'.format(name, s))
+
+    if any(s != 'done' and s != 'skipped' for s in status.values()):
+        sys.exit(1)
@@ -0,0 +1,5 @@
+#######################################################################################################
+#
+# Helper modules shared by the pipeline scripts (1_data_import.py, 2_data_consol.py, 3_gen_plots.py).
+#
+#######################################################################################################
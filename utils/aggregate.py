@@ -0,0 +1,77 @@
+#######################################################################################################
+#
+# Weighted aggregation of the panel by grouping sets.
+#
+# Weighted means are computed as sum(w * x) / sum(w) from grouped sums: the products and weights
+# of all columns are summed in one groupby at the finest level needed by the grouping sets, and
+# each set (e.g. Brazil, Region and State by year) is rolled up from those sums, so the panel is
+# grouped once whatever the number of sets and columns. All rollup levels can be stacked in one
+# long table, which is small enough to be cached and read by the plots instead of the panel.
+#
+#######################################################################################################
+
+import numpy as np
+import pandas as pd
+
+
+def weighted_agg(df, sets, weight = 'births', **aggs):
+    # one data frame per grouping set in 'sets' (lists of key columns), sorted by its keys, with
+    # one column per named aggregation, as in groupby().agg(name = (column, how)):
+    #   how = 'wmean': mean of the column weighted by 'weight'; missing values are left out with
+    #                  their weight, and groups with zero total weight get nan
+    #   how = 'sum': sum of the column
+
+    # finest level: all keys used by the sets, in order of first appearance
+    keys = []
+    for s in sets:
+        keys += [k for k in s if k not in keys]
+
+    w = df[weight].to_numpy(dtype = 'float64', na_value = np.nan)
+
+    parts = {}
+    for name, (col, how) in aggs.items():
+        if how == 'wmean':
+            x = df[col].to_numpy(dtype = 'float64', na_value = np.nan)
+            valid = ~np.isnan(x) & ~np.isnan(w)
+            parts['wx:' + name] = np.where(valid, w * x, 0.0)
+            parts['w:' + name] = np.where(valid, w, 0.0)
+        elif how == 'sum':
+            parts['sum:' + name] = df[col]
+        else:
+            raise ValueError('unknown aggregation: ' + str(how))
+
+    sums = pd.DataFrame(parts, index = df.index)
+    sums = pd.concat([df[keys], sums], axis = 1).groupby(keys, sort = False).sum()
+
+    frames = []
+    for s in sets:
+        rolled = sums.groupby(level = list(s), sort = True).sum() if list(s) != keys else sums.sort_index()
+
+        out = pd.DataFrame(index = rolled.index)
+        for name, (col, how) in aggs.items():
+            if how == 'wmean':
+                total = rolled['w:' + name].to_numpy()
+                out[name] = np.divide(rolled['wx:' + name].to_numpy(), total,
+                                      out = np.full(len(total), np.nan), where = total != 0)
+            else:
+                out[name] = rolled['sum:' + name]
+
+        frames.append(out.reset_index())
+
+    return frames
+
+
+def rollups(df, levels, weight = 'births', **aggs):
+    # all grouping sets of 'levels' ({level name: key columns}) stacked in one table, with a
+    # 'level' column and the union of the keys (missing where a level doesn't use a key)
+
+    frames = weighted_agg(df, list(levels.values()), weight = weight, **aggs)
+
+    keys = []
+    for s in levels.values():
+        keys += [k for k in s if k not in keys]
+
+    for level, frame in zip(levels, frames):
+        frame.insert(0, 'level', level)
+
+    return pd.concat(frames, ignore_index = True)[['level'] + keys + list(aggs)]
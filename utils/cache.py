@@ -0,0 +1,80 @@
+#######################################################################################################
+#
+# On-disk cache for TabNet/SIOPS responses.
+#
+# Each response is stored under the hash of its (URL, POST body) as gzip-compressed HTML, next to a
+# small json file with the URL, the fetch time and the time-to-live (ttl) of the entry.
+# Entries with ttl None never expire, which is what we want for closed years.
+#
+#######################################################################################################
+
+import os
+import json
+import gzip
+import hashlib
+import time
+from datetime import date
+
+
+# Keys and paths
+# -----------------------------------------------------------------
+
+def cache_key(url, data):
+    body = data if isinstance(data, bytes) else str(data).encode('utf-8')
+    return hashlib.sha256(url.encode('utf-8') + b'\n' + body).hexdigest()
+
+
+def cache_paths(folder, key):
+    # entries are spread over 256 sub folders
+    subfolder = os.path.join(folder, key[0:2])
+    return os.path.join(subfolder, key + '.html.gz'), os.path.join(subfolder, key + '.json')
+
+
+# Time-to-live by year
+# -----------------------------------------------------------------
+
+def year_ttl(year, open_years = 2, ttl = 7 * 24 * 3600):
+    # the last 'open_years' years may still be revised by DATASUS and expire after 'ttl' seconds;
+    # older years are closed and never expire
+    if year > date.today().year - open_years:
+        return ttl
+    return None
+
+
+# Reading and writing
+# -----------------------------------------------------------------
+
+def cache_get(folder, url, data, now = None, ignore_ttl = False):
+    # returns the cached HTML, or None if the entry is missing or expired (expired entries are
+    # still returned with ignore_ttl, e.g. offline)
+
+    file_html, file_meta = cache_paths(folder, cache_key(url, data))
+
+    if not (os.path.exists(file_html) and os.path.exists(file_meta)):
+        return None
+
+    with open(file_meta, 'r') as f:
+        meta = json.load(f)
+
+    now = time.time() if now is None else now
+    if not ignore_ttl and meta['ttl'] is not None and now - meta['fetched_at'] > meta['ttl']:
+        return None
+
+    with gzip.open(file_html, 'rt', encoding = 'utf-8') as f:
+        return f.read()
+
+
+def cache_put(folder, url, data, html, ttl = None):
+
+    file_html, file_meta = cache_paths(folder, cache_key(url, data))
+    os.makedirs(os.path.dirname(file_html), exist_ok = True)
+
+    # html first and then meta, each through a temporary file, so a partial write is never read as a hit
+    with gzip.open(file_html + '.tmp', 'wt', encoding = 'utf-8') as f:
+        f.write(html)
+    os.replace(file_html + '.tmp', file_html)
+
+    meta = {'url': url, 'fetched_at': time.time(), 'ttl': ttl}
+    with open(file_meta + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(file_meta + '.tmp', file_meta)
@@ -0,0 +1,81 @@
+#######################################################################################################
+#
+# Changes of a measure between years (or periods) for every unit of a panel.
+#
+# The measure is pivoted once to a units x years matrix, with units located by their keys and
+# years by their value, so the result doesn't depend on how the panel is sorted or on all years
+# being there (missing unit-years are nan). Differences, ratios and annualized growth between two
+# years, or between the averages of two periods, are then one vectorized operation on two columns
+# of the matrix. Units can be municipalities, states, regions or any set of key columns.
+#
+#######################################################################################################
+
+import numpy as np
+import pandas as pd
+
+
+def year_matrix(df, value, by = 'mun_code', year = 'year'):
+    # dict with the units (index of the key columns 'by'), the sorted years and the matrix of
+    # 'value' (float64, units x years)
+
+    keys = [by] if isinstance(by, str) else list(by)
+    units = pd.MultiIndex.from_frame(df[keys]) if len(keys) > 1 else pd.Index(df[keys[0]])
+
+    u, units = units.factorize(sort = True)
+    years, t = np.unique(df[year].to_numpy(), return_inverse = True)
+
+    if len(np.unique(u * len(years) + t)) < len(df):
+        raise ValueError('more than one row per unit and year for: ' + ', '.join(keys))
+
+    matrix = np.full((len(units), len(years)), np.nan)
+    matrix[u, t] = df[value].to_numpy(dtype = 'float64', na_value = np.nan)
+
+    return {'units': units.set_names(keys), 'years': years, 'matrix': matrix, 'value': value}
+
+
+def period_values(panel, period):
+    # values in a year, or mean values over a period (first, last), with the (middle) year; years
+    # of the period missing from the panel are left out, and all-missing periods give nan
+
+    first, last = period if isinstance(period, (tuple, list)) else (period, period)
+    cols = (panel['years'] >= first) & (panel['years'] <= last)
+
+    values = panel['matrix'][:, cols]
+    n = (~np.isnan(values)).sum(axis = 1)
+    mean = np.divide(np.nansum(values, axis = 1), n, out = np.full(len(n), np.nan), where = n > 0)
+
+    return mean, (first + last) / 2
+
+
+def change(panel, start, end, how = 'diff'):
+    # change of every unit of 'panel' (see year_matrix) between 'start' and 'end' (years, or
+    # periods (first, last) compared by their means), as a series indexed by the units:
+    #   how = 'diff': end - start
+    #   how = 'ratio': end / start
+    #   how = 'growth': annualized growth rate, (end / start) ** (1 / years between them) - 1,
+    #                   with periods dated by their middle year
+    # a missing value at either end gives nan, and so do ratios and growth from zero
+
+    a, t0 = period_values(panel, start)
+    b, t1 = period_values(panel, end)
+
+    out = np.full(len(a), np.nan)
+
+    if how == 'diff':
+        out = b - a
+    elif how == 'ratio':
+        np.divide(b, a, out = out, where = a != 0)
+    elif how == 'growth':
+        if t1 == t0:
+            raise ValueError('annualized growth needs two different years')
+        np.divide(b, a, out = out, where = a != 0)
+        out = np.power(out, 1.0 / (t1 - t0)) - 1
+    else:
+        raise ValueError('unknown change: ' + str(how))
+
+    return pd.Series(out, index = panel['units'], name = panel['value'])
+
+
+def panel_change(df, value, start, end, how = 'diff', by = 'mun_code', year = 'year'):
+    # change(year_matrix(df, value, by, year), start, end, how)
+    return change(year_matrix(df, value, by = by, year = year), start, end, how = how)
@@ -0,0 +1,25 @@
+#######################################################################################################
+#
+# Code files of each pipeline stage (paths from the project folder).
+#
+# run_pipeline.py reruns a stage when one of its code files changes, and the scripts that keep
+# their own state (2_data_consol.py, the rollups cache of 3_gen_plots.py) hash the same lists to
+# decide when to rebuild it, so both decisions always agree.
+#
+#######################################################################################################
+
+
+import_code = ['1_data_import.py', 'utils/storage.py']
+
+scrape_code = import_code + ['utils/tabnet.py', 'utils/fetch.py', 'utils/cache.py', 'utils/manifest.py', 'utils/scheduler.py']
+
+sim_code = import_code + ['utils/sim.py', 'utils/icd.py']
+
+consol_code = ['2_data_consol.py', 'utils/storage.py', 'utils/panel.py', 'utils/rates.py', 'utils/incremental.py', 'utils/mapped.py']
+
+# code that builds the Brazil/Region/State rollups cached in df_agg.parquet
+rollups_code = ['3_gen_plots.py', 'utils/storage.py', 'utils/mapped.py', 'utils/aggregate.py']
+
+plots_code = rollups_code + ['utils/changes.py', 'utils/figures.py']
+
+regressions_code = ['4_regressions.py', 'utils/mapped.py', 'utils/fe.py']
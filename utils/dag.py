@@ -0,0 +1,216 @@
+#######################################################################################################
+#
+# Pipeline stages and a runner that skips the ones that are up to date.
+#
+# A stage is a callable with declared input files, output files and code files. A stage depends on
+# the stages that write its inputs. The runner starts every stage as soon as the stages it depends
+# on are done, so independent stages run in parallel threads, and skips a stage when its code and
+# inputs hash the same as in its last successful run and its outputs are still there.
+#
+# Files are hashed by content (sha256), but a file whose size and modification time are the same
+# as when it was last hashed keeps its hash, so an up-to-date pipeline is checked in milliseconds.
+# Stages that read from the web have no input files: they are re-run when their 'ttl' expires.
+#
+#######################################################################################################
+
+import os
+import json
+import time
+import hashlib
+import runpy
+import threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+# Stages
+# -----------------------------------------------------------------
+
+def stage(name, func, inputs = (), outputs = (), code = (), ttl = None):
+    # 'inputs', 'outputs' and 'code' are files or folders; 'ttl' (seconds) re-runs the stage
+    # when its last run is older than that, even if nothing changed locally
+    return {'name': name, 'func': func, 'inputs': list(inputs), 'outputs': list(outputs), 'code': list(code), 'ttl': ttl}
+
+
+def load_script(file, name = None):
+    # imports a pipeline script (their names start with a digit, so 'import' can't be used);
+    # the script's '__main__' block is not run
+    name = name or os.path.splitext(os.path.basename(file))[0].lstrip('0123456789_')
+    spec = importlib.util.spec_from_file_location(name, file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_script(file):
+    # runs a whole script as a stage
+    return lambda: runpy.run_path(file, run_name = '__main__')
+
+
+def dependencies(stages):
+    # {stage name: names of the stages that write its inputs}
+    writers = {}
+    for s in stages:
+        for path in s['outputs']:
+            writers[os.path.normpath(path)] = s['name']
+
+    return {s['name']: sorted({writers[os.path.normpath(path)] for path in s['inputs'] if os.path.normpath(path) in writers} - {s['name']})
+            for s in stages}
+
+
+# Hashing
+# -----------------------------------------------------------------
+
+def file_hash(path, known):
+    # 'known' maps path -> [size, mtime_ns, hash] from earlier runs and is updated in place
+
+    st = os.stat(path)
+    entry = known.get(path)
+
+    if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+        return entry[2]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+    known[path] = [st.st_size, st.st_mtime_ns, digest.hexdigest()]
+    return known[path][2]
+
+
+def path_hash(path, known):
+    # a file's hash, a folder's combined hash (all files in it) or None if it does not exist
+
+    if os.path.isfile(path):
+        return file_hash(path, known)
+
+    if not os.path.isdir(path):
+        return None
+
+    digest = hashlib.sha256()
+    for root, dirs, files in sorted(os.walk(path)):
+        for f in sorted(files):
+            if f.endswith('.tmp'):
+                continue
+            file = os.path.join(root, f)
+            digest.update(os.path.relpath(file, path).encode('utf-8'))
+            digest.update(file_hash(file, known).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def stage_key(s, known):
+    # hashes that decide whether a stage is up to date
+    return {'code': {path: path_hash(path, known) for path in s['code']},
+            'inputs': {path: path_hash(path, known) for path in s['inputs']}}
+
+
+# State of the last runs
+# -----------------------------------------------------------------
+
+def load_runs(file):
+    if not os.path.exists(file):
+        return {'stages': {}, 'files': {}}
+
+    with open(file, 'r') as f:
+        return json.load(f)
+
+
+def save_runs(file, runs):
+    folder = os.path.dirname(file)
+    if folder:
+        os.makedirs(folder, exist_ok = True)
+
+    with open(file + '.tmp', 'w') as f:
+        json.dump(runs, f, indent = 1, sort_keys = True)
+    os.replace(file + '.tmp', file)
+
+
+def is_up_to_date(s, key, last, now = None):
+    now = time.time() if now is None else now
+
+    if last is None or last['code'] != key['code'] or last['inputs'] != key['inputs']:
+        return False
+
+    if any(not os.path.exists(path) for path in s['outputs']):
+        return False
+
+    if s['ttl'] is not None and now - last['finished_at'] > s['ttl']:
+        return False
+
+    return True
+
+
+# Runner
+# -----------------------------------------------------------------
+
+def run_stages(stages, state_file, max_workers = 4, force = ()):
+    # runs the stages that are not up to date, in dependency order, independent ones in parallel;
+    # 'force' lists stage names to run anyway. Returns {stage name: 'skipped' | 'done' | 'failed' | 'not run'}
+
+    by_name = {s['name']: s for s in stages}
+    deps = dependencies(stages)
+
+    runs = load_runs(state_file)
+    known = runs['files']
+    lock = threading.Lock() # 'runs' and 'known' are shared by the stages
+
+    status = {}
+    errors = {}
+
+    def run(name):
+        s = by_name[name]
+
+        with lock:
+            key = stage_key(s, known)
+
+        if name not in force and is_up_to_date(s, key, runs['stages'].get(name)):
+            return 'skipped'
+
+        print('_____ running stage ' + name + ' _____')
+        t0 = time.time()
+        s['func']()
+
+        with lock:
+            runs['stages'][name] = dict(key, finished_at = time.time(), seconds = time.time() - t0)
+            save_runs(state_file, runs)
+
+        return 'done'
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        running = {}
+
+        while True:
+            # start every stage whose dependencies are done (or skipped)
+            for name in by_name:
+                if name in status or name in running.values():
+                    continue
+
+                if any(status.get(d) in ('failed', 'not run') for d in deps[name]):
+                    status[name] = 'not run'
+                elif all(status.get(d) in ('done', 'skipped') for d in deps[name]):
+                    running[executor.submit(run, name)] = name
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when = FIRST_COMPLETED)
+
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    status[name] = future.result()
+                except Exception as e:
+                    status[name] = 'failed'
+                    errors[name] = e
+
+    status = {name: status.get(name, 'not run') for name in by_name}
+
+    with lock:
+        save_runs(state_file, runs)
+
+    for name, e in errors.items():
+        print('stage ' + name + ' failed: ' + repr(e))
+
+    return status
@@ -0,0 +1,147 @@
+#######################################################################################################
+#
+# Weighted two-way fixed-effects regressions (e.g. municipality and year) for many outcomes at once.
+#
+# The fixed effects are absorbed, not estimated: the outcomes and regressors are demeaned by
+# alternating projections (subtract the weighted mean by municipality, then by year, ... until
+# nothing changes), with the group means computed by np.bincount on integer codes, so no dummy
+# matrix is built. Outcomes with the same missing rows are demeaned together with the regressors
+# in one matrix, and solved together with the same X'WX; standard errors are clustered (CR1, as
+# in Stata) with the cluster sums of the scores also computed by bincount.
+# The small-sample factor counts the degrees of freedom of the absorbed fixed effects as reghdfe
+# does: none for those nested in the clusters (municipality FE, clustered by municipality), all
+# the levels of the others (year FE) but the redundant ones. Singletons (groups of one
+# observation, fit exactly by their fixed effect) are dropped first, also as in reghdfe.
+#
+#######################################################################################################
+
+import math
+import numpy as np
+import pandas as pd
+
+
+def group_codes(values):
+    # integer codes 0..n-1 of a column (or of the rows of several columns)
+    return pd.factorize(pd.MultiIndex.from_frame(values) if isinstance(values, pd.DataFrame) else values)[0]
+
+
+def demean(M, groups, w, tol = 1e-10, max_iter = 10000):
+    # M (rows x columns) minus its weighted projection on the dummies of all 'groups' (lists of
+    # integer codes), by alternating projections; stops when the largest change in a sweep is
+    # below tol (relative to the largest value), and raises if it doesn't converge
+
+    M = np.array(M, dtype = 'float64', order = 'F') # columns are contiguous for bincount
+    totals = [np.bincount(g, w) for g in groups]
+    scale = max(np.abs(M).max(), 1.0) if M.size else 1.0
+
+    for _ in range(max_iter):
+        change = 0.0
+        for g, total in zip(groups, totals):
+            for j in range(M.shape[1]):
+                means = np.divide(np.bincount(g, w * M[:, j], minlength = len(total)), total,
+                                  out = np.zeros(len(total)), where = total > 0)
+                M[:, j] -= means[g]
+                change = max(change, np.abs(means).max())
+        if change <= tol * scale or len(groups) == 1:
+            return M
+
+    raise RuntimeError('fixed effects did not converge in ' + str(max_iter) + ' iterations')
+
+
+def drop_singletons(rows, codes):
+    # 'rows' without the observations alone in a group of any of the fixed effects (integer codes
+    # over all rows), repeated until none is left, since dropping some can leave new singletons
+    rows = rows.copy()
+    while True:
+        single = np.zeros(len(rows), dtype = bool)
+        for c in codes:
+            counts = np.bincount(c[rows], minlength = c.max() + 1)
+            single[rows] |= counts[c[rows]] == 1
+        if not single.any():
+            return rows
+        rows &= ~single
+
+
+def absorbed_df(groups, clusters):
+    # degrees of freedom of the fixed effects, for the small-sample factor: 0 for a fixed effect
+    # nested in the clusters (every group within one cluster; G / (G - 1) already accounts for
+    # it), else its number of levels, minus one redundant level for each one after the first
+    # (the redundant levels are exact when the groups are connected, as in the panel)
+
+    n_clusters = clusters.max() + 1
+    df_a = 0
+    for i, g in enumerate(groups):
+        n_groups = g.max() + 1
+        nested = len(np.unique(g.astype('int64') * n_clusters + clusters)) == n_groups
+        if not nested:
+            df_a += n_groups - (i > 0)
+
+    return df_a
+
+
+def cluster_vcov(X, W_E, bread, clusters, df_a = 0):
+    # CR1 covariance of the coefficients of every outcome, from the weighted residuals W_E
+    # (rows x outcomes): bread . (sum over clusters of the score sums' outer products) . bread,
+    # times G / (G - 1) * (n - 1) / (n - k - df_a), with df_a from absorbed_df()
+
+    n, k = X.shape
+    G = clusters.max() + 1
+    c = G / (G - 1) * (n - 1) / (n - k - df_a)
+
+    vcov = np.empty((W_E.shape[1], k, k))
+    for m in range(W_E.shape[1]):
+        scores = np.column_stack([np.bincount(clusters, X[:, j] * W_E[:, m], minlength = G) for j in range(k)])
+        vcov[m] = c * bread @ (scores.T @ scores) @ bread
+
+    return vcov
+
+
+def fe_regressions(df, outcomes, regressors, absorb = ('mun_code', 'year'), weight = 'births', cluster = 'mun_code'):
+    # weighted least squares of each outcome on the regressors with fixed effects for every
+    # column in 'absorb', errors clustered by 'cluster'. Each outcome uses the rows where it, the
+    # regressors and the weight are not missing and the weight is positive, less the singletons.
+    # Returns one row per outcome and regressor: coef, se, t, p (normal), nobs, clusters and the
+    # within R2.
+
+    regressors = list(regressors)
+    w_all = df[weight].to_numpy(dtype = 'float64', na_value = np.nan)
+    X_all = df[regressors].to_numpy(dtype = 'float64', na_value = np.nan)
+    Y_all = df[outcomes].to_numpy(dtype = 'float64', na_value = np.nan)
+
+    codes = [group_codes(df[col]) for col in absorb]
+    base = (w_all > 0) & ~np.isnan(X_all).any(axis = 1) & (np.array(codes) >= 0).all(axis = 0)
+
+    # outcomes with the same missing rows share the demeaning and X'WX
+    patterns = {}
+    for m, col in enumerate(outcomes):
+        rows = drop_singletons(base & ~np.isnan(Y_all[:, m]), codes)
+        patterns.setdefault(rows.tobytes(), (rows, []))[1].append(m)
+
+    results = {}
+    for rows, ms in patterns.values():
+        w = w_all[rows]
+        groups = [group_codes(c[rows]) for c in codes]
+        clusters = group_codes(df.loc[rows, cluster])
+
+        M = demean(np.column_stack([X_all[rows], Y_all[rows][:, ms]]), groups, w)
+        X, Y = M[:, :len(regressors)], M[:, len(regressors):]
+
+        bread = np.linalg.inv(X.T @ (w[:, None] * X))
+        B = bread @ (X.T @ (w[:, None] * Y))
+        E = Y - X @ B
+
+        vcov = cluster_vcov(X, w[:, None] * E, bread, clusters, absorbed_df(groups, clusters))
+        r2 = 1 - (w[:, None] * E ** 2).sum(axis = 0) / (w[:, None] * Y ** 2).sum(axis = 0)
+
+        for i, m in enumerate(ms):
+            results[m] = (B[:, i], np.sqrt(np.diag(vcov[i])), rows.sum(), clusters.max() + 1, r2[i])
+
+    out = []
+    for m, col in enumerate(outcomes):
+        coef, se, nobs, n_clusters, r2 = results[m]
+        for j, var in enumerate(regressors):
+            t = coef[j] / se[j]
+            out.append({'outcome': col, 'variable': var, 'coef': coef[j], 'se': se[j], 't': t,
+                        'p': math.erfc(abs(t) / math.sqrt(2)), 'nobs': nobs, 'clusters': n_clusters, 'r2_within': r2})
+
+    return pd.DataFrame(out)
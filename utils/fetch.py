@@ -0,0 +1,109 @@
+#######################################################################################################
+#
+# Fetching TabNet/SIOPS tables from DATASUS.
+#
+# Requests are described as dicts {'url', 'data', 'headers'} and run concurrently over a pooled
+# session (keep-alive connections are reused). How many requests run at once on each host, and
+# the retries of failed ones, are handled by the scheduler (utils/scheduler.py).
+# Responses come back in the same order as the requests.
+#
+# With a cache folder, responses are served from / saved to the on-disk cache (utils/cache.py).
+# A request may carry a 'ttl' (seconds, None = never expires) for its cache entry.
+# In offline mode only the cache is used, expired entries included, and a missing entry is an error.
+#
+# 'on_result(i, html)' is called as soon as the i-th request completes (e.g. to save it right away),
+# and 'on_error(i, error)' when it fails; requests already completed are not lost if another fails.
+#
+#######################################################################################################
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.cache import cache_get, cache_put
+from utils.scheduler import Scheduler
+
+
+# Pooled session
+# -----------------------------------------------------------------
+
+def make_session(pool_size = 10):
+    session = requests.Session()
+
+    adapter = HTTPAdapter(pool_connections = 4, pool_maxsize = pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+# Concurrent fetching
+# -----------------------------------------------------------------
+
+def fetch_all(reqs, scheduler = None, session = None, timeout = 20, cache_folder = None, offline = False,
+              on_result = None, on_error = None):
+    # POSTs every request and returns the response texts in the order of 'reqs'
+
+    if offline and cache_folder is None:
+        raise ValueError('offline mode needs a cache folder')
+
+    if scheduler is None:
+        scheduler = Scheduler()
+
+    if session is None:
+        session = make_session(pool_size = scheduler.max_per_host)
+
+    hosts = [urlparse(r['url']).netloc for r in reqs]
+
+    def fetch_one(i):
+        # (html, whether it came from the cache)
+        r = reqs[i]
+
+        if cache_folder is not None:
+            html = cache_get(cache_folder, r['url'], r['data'], ignore_ttl = offline)
+
+            if html is not None:
+                return html, True
+
+            if offline:
+                raise RuntimeError('offline mode: no cached response for ' + r['url'] + ' ' + str(r['data'])[0:120])
+
+        send = lambda: session.post(r['url'],
+                                    headers = r['headers'],
+                                    data = r['data'],
+                                    verify = False,
+                                    timeout = timeout)
+
+        response = scheduler.run(hosts[i], send, label = r.get('label', ''))
+        response.raise_for_status()
+
+        return response.text, False
+
+    def fetch(i):
+        r = reqs[i]
+
+        try:
+            html, cached = fetch_one(i)
+            if on_result is not None:
+                on_result(i, html)
+
+            # a response is cached only once it has been handled, so a bad page is not replayed
+            if cache_folder is not None and not cached:
+                cache_put(cache_folder, r['url'], r['data'], html, ttl = r.get('ttl'))
+
+        except Exception as error:
+            if on_error is not None:
+                on_error(i, error)
+            raise
+
+        return html
+
+    if len(reqs) == 0:
+        return []
+
+    n_workers = scheduler.max_per_host * len(set(hosts))
+
+    with ThreadPoolExecutor(max_workers = n_workers) as pool:
+        return list(pool.map(fetch, range(len(reqs))))
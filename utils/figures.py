@@ -0,0 +1,225 @@
+#######################################################################################################
+#
+# Rendering of the plotly express figures to html pages, in parallel.
+#
+# A figure is described by a picklable spec (the data frame, the plotly express function and its
+# arguments, and the layout and axes updates), so figures can be built and written in worker
+# processes. Besides plotly express, there is an animated scatter for tens of thousands of points
+# (animated_scatter_gl), drawn with WebGL, with compact frames and optional level of detail.
+# The pages don't embed plotly.js (about 3.5 MB each): they all load one copy of it, written next
+# to them, by a relative path, so they still work offline (no CDN).
+#
+#######################################################################################################
+
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.offline as py
+import plotly.graph_objects as go
+
+
+# name of the shared plotly.js file, in the folder of the pages
+plotlyjs_file = 'plotly.min.js'
+
+
+def figure(file, plot, data, layout = None, xaxes = None, **args):
+    # spec of the figure px.<plot>(data, **args) (or of a function of 'plots' below), with
+    # fig.update_layout(**layout) and fig.update_xaxes(**xaxes), written to 'file'
+    return {'file': file, 'plot': plot, 'data': data, 'args': args,
+            'layout': layout or {}, 'xaxes': xaxes or {}}
+
+
+def build_figure(spec):
+    make = plots[spec['plot']] if spec['plot'] in plots else getattr(px, spec['plot'])
+    fig = make(spec['data'], **spec['args'])
+    if spec['layout']:
+        fig.update_layout(**spec['layout'])
+    if spec['xaxes']:
+        fig.update_xaxes(**spec['xaxes'])
+    return fig
+
+
+# Animated scatter at the municipality scale
+# -----------------------------------------------------------------
+
+# px.scatter with an animation frame repeats every point's name, id and hover template in every
+# frame, and its svg traces redraw thousands of bubbles slowly. Here every point (animation group)
+# keeps its place in its trace in all frames, so names, colors and the hover template are stored
+# once; a frame only carries the positions and sizes of its year, as float32 arrays (typed arrays
+# in the page), with nan positions where a point has no data that year.
+
+def frame_controls(frames, label, duration):
+    # play/pause buttons and year slider, as in plotly express; WebGL traces are redrawn on every
+    # frame and can't be tweened, so there is no transition
+    step = lambda d: {'frame': {'duration': d, 'redraw': True}, 'mode': 'immediate',
+                      'fromcurrent': True, 'transition': {'duration': 0}}
+
+    updatemenus = [{'buttons': [{'args': [None, step(duration)], 'label': '&#9654;', 'method': 'animate'},
+                                {'args': [[None], step(0)], 'label': '&#9724;', 'method': 'animate'}],
+                    'direction': 'left', 'pad': {'r': 10, 't': 70}, 'showactive': False, 'type': 'buttons',
+                    'x': 0.1, 'xanchor': 'right', 'y': 0, 'yanchor': 'top'}]
+
+    sliders = [{'active': 0, 'currentvalue': {'prefix': label + '='}, 'len': 0.9, 'pad': {'b': 10, 't': 60},
+                'x': 0.1, 'xanchor': 'left', 'y': 0, 'yanchor': 'top',
+                'steps': [{'args': [[f], step(0)], 'label': f, 'method': 'animate'} for f in frames]}]
+
+    return updatemenus, sliders
+
+
+def bin_cells(v, limits, bins):
+    # grid column of each value: 1 to bins inside 'limits', 0 below and bins + 1 above (so points
+    # out of the axes are not mixed with the ones inside)
+    lo, hi = limits
+    cells = np.floor((v - lo) / (hi - lo) * bins) + 1
+    return np.clip(np.nan_to_num(cells), 0, bins + 1).astype('int64')
+
+
+def animated_scatter_gl(data, x, y, animation_frame, animation_group, color, hover_name, size,
+                        size_max = 20, range_x = None, range_y = None, title = None,
+                        top = None, bins = 40, duration = 500):
+    # same chart as px.scatter(data, x, y, animation_frame, animation_group, color, hover_name,
+    # size, size_max, range_x, range_y, title), with scattergl traces. With 'top', only the 'top'
+    # largest points (by their largest size) are drawn individually; the others are binned, by
+    # color, in a bins x bins grid over the axes ranges (or the data ranges), and each cell is drawn
+    # as one bubble, at the size-weighted mean position of its points, with their total size.
+
+    values = np.sort(data[animation_frame].unique())
+    frames = [str(v) for v in values]
+    t = np.searchsorted(values, data[animation_frame].to_numpy())
+    g, groups = pd.factorize(data[animation_group])
+
+    # one row per point, one column per frame
+    def wide(col):
+        out = np.full((len(groups), len(values)), np.nan)
+        out[g, t] = data[col].to_numpy(dtype = 'float64', na_value = np.nan)
+        return out
+
+    X, Y, S = wide(x), wide(y), wide(size)
+    S[np.isnan(X) | np.isnan(Y)] = np.nan
+
+    first = np.unique(g, return_index = True)[1]
+    names = data[hover_name].to_numpy()[first]
+    point_colors = data[color].to_numpy()[first]
+
+    # points drawn individually
+    largest = np.where(np.isnan(S), -np.inf, S).max(axis = 1)
+    detail = np.ones(len(groups), dtype = bool)
+    if top is not None and top < len(groups):
+        detail[:] = False
+        detail[np.argsort(-largest, kind = 'stable')[:top]] = True
+
+    sizeref = 2.0 * np.nanmax(S) / size_max ** 2
+    palette = px.colors.qualitative.Plotly
+
+    f4 = lambda a: a.astype('float32')
+
+    traces, frame_traces = [], []
+    for i, c in enumerate(pd.unique(point_colors)):
+        marker = {'color': palette[i % len(palette)], 'sizemode': 'area', 'sizeref': sizeref, 'symbol': 'circle'}
+        hover = (color + '=' + str(c) + '<br>' + animation_frame + '=%{meta}<br>' + x + '=%{x}<br>'
+                 + y + '=%{y}<br>' + size + '=%{marker.size}<extra></extra>')
+
+        rows = np.flatnonzero((point_colors == c) & detail)
+        traces.append({'type': 'scattergl', 'mode': 'markers', 'name': str(c), 'legendgroup': str(c),
+                       'showlegend': True, 'marker': marker, 'hovertext': names[rows],
+                       'hovertemplate': '<b>%{hovertext}</b><br><br>' + hover})
+        frame_traces.append([{'x': f4(X[rows, j]), 'y': f4(Y[rows, j]), 'marker': {'size': f4(np.nan_to_num(S[rows, j]))},
+                              'meta': frames[j]} for j in range(len(frames))])
+
+        rows = np.flatnonzero((point_colors == c) & ~detail)
+        if len(rows) == 0:
+            continue
+
+        # cell of every point and frame with data, numbered within the color
+        valid = ~np.isnan(S[rows])
+        p, j = np.nonzero(valid)
+        xs, ys, ss = X[rows][valid], Y[rows][valid], S[rows][valid]
+        cells = (bin_cells(xs, range_x or (np.nanmin(X), np.nanmax(X)), bins) * (bins + 2)
+                 + bin_cells(ys, range_y or (np.nanmin(Y), np.nanmax(Y)), bins))
+        k, cell_ids = pd.factorize(cells)
+
+        shape = (len(cell_ids), len(frames))
+        key = k * len(frames) + j
+        total = np.bincount(key, ss, minlength = shape[0] * shape[1]).reshape(shape)
+        count = np.bincount(key, minlength = shape[0] * shape[1]).reshape(shape)
+        mean = lambda v: np.divide(np.bincount(key, ss * v, minlength = total.size).reshape(shape), total,
+                                   out = np.full(shape, np.nan), where = total > 0)
+        BX, BY = mean(xs), mean(ys)
+
+        traces.append({'type': 'scattergl', 'mode': 'markers', 'name': str(c), 'legendgroup': str(c),
+                       'showlegend': False, 'marker': dict(marker, opacity = 0.6),
+                       'hovertemplate': '<b>' + hover_name + ' bin: %{customdata}</b><br><br>' + hover})
+        frame_traces.append([{'x': f4(BX[:, j]), 'y': f4(BY[:, j]), 'marker': {'size': f4(total[:, j])},
+                              'customdata': count[:, j].astype('int32'), 'meta': frames[j]} for j in range(len(frames))])
+
+    # the first frame is shown before playing
+    for trace, steps in zip(traces, frame_traces):
+        trace.update({k: v for k, v in steps[0].items() if k != 'marker'})
+        trace['marker'] = dict(trace['marker'], size = steps[0]['marker']['size'])
+
+    updatemenus, sliders = frame_controls(frames, animation_frame, duration)
+
+    layout = {'xaxis': {'title': {'text': x}}, 'yaxis': {'title': {'text': y}},
+              'legend': {'title': {'text': color}, 'tracegroupgap': 0, 'itemsizing': 'constant'},
+              'margin': {'t': 60}, 'updatemenus': updatemenus, 'sliders': sliders}
+    if range_x is not None:
+        layout['xaxis']['range'] = range_x
+    if range_y is not None:
+        layout['yaxis']['range'] = range_y
+    if title is not None:
+        layout['title'] = {'text': title}
+
+    return go.Figure(data = traces, layout = layout,
+                     frames = [{'name': f, 'data': [steps[j] for steps in frame_traces],
+                                'traces': list(range(len(traces)))} for j, f in enumerate(frames)])
+
+
+# figures built by this module, by name (the others are plotly express functions)
+plots = {'animated_scatter_gl': animated_scatter_gl}
+
+
+def render(spec):
+    # builds the figure and writes its page, which loads plotly.js from its own folder
+    build_figure(spec).write_html(spec['file'], include_plotlyjs = plotlyjs_file)
+    return spec['file']
+
+
+def write_plotlyjs(folder):
+    # the plotly.js bundle of the installed plotly, rewritten only when missing or different
+    # (after an upgrade), atomically
+    file = os.path.join(folder, plotlyjs_file)
+    bundle = py.get_plotlyjs()
+
+    if os.path.exists(file):
+        with open(file, encoding = 'utf-8') as f:
+            if f.read() == bundle:
+                return file
+
+    with open(file + '.tmp', 'w', encoding = 'utf-8') as f:
+        f.write(bundle)
+    os.replace(file + '.tmp', file)
+    return file
+
+
+def write_figures(figures, folder, workers = None):
+    # writes the pages of all figure specs (all in 'folder') and the shared plotly.js, with the
+    # figures built in 'workers' processes (all cores if None; in this process if 1). The largest
+    # data sets go first, so the slowest figure is not started last.
+
+    os.makedirs(folder, exist_ok = True)
+    write_plotlyjs(folder)
+
+    workers = min(workers or multiprocessing.cpu_count(), len(figures))
+    figures = sorted(figures, key = lambda spec: len(spec['data']), reverse = True)
+
+    if workers <= 1:
+        return [render(spec) for spec in figures]
+
+    context = multiprocessing.get_context('spawn') # safe when called from a multi-threaded process
+
+    with ProcessPoolExecutor(max_workers = workers, mp_context = context) as executor:
+        return list(executor.map(render, figures))
@@ -0,0 +1,76 @@
+#######################################################################################################
+#
+# Classifying ICD-10 codes against named code lists (e.g. causes amenable to primary care).
+#
+# All lists are compiled into one prefix index: a code in a list matches itself and every more
+# detailed code below it, so "A33" matches "A33", "A330" and "A33X", while "A330" only matches
+# "A330". Each distinct ICD code is classified once and the result is broadcast to every death
+# through the category codes, so there is no per-row string matching.
+#
+#######################################################################################################
+
+import numpy as np
+import pandas as pd
+
+
+# Normalizing codes
+# -----------------------------------------------------------------
+
+def normalize_icd(code):
+    # 'a33.0 ' -> 'A330'
+    return str(code).strip().upper().replace('.', '')
+
+
+# Compiling code lists
+# -----------------------------------------------------------------
+
+def compile_icd_lists(lists):
+    # 'lists' maps a name to a list of ICD codes; duplicated codes are dropped.
+    # Each prefix in the index points to a bit mask of the lists it belongs to (bit i = i-th list).
+
+    prefixes = {}
+
+    for i, codes in enumerate(lists.values()):
+        for code in set(map(normalize_icd, codes)):
+            prefixes[code] = prefixes.get(code, 0) | (1 << i)
+
+    index = {'names': list(lists),
+             'prefixes': prefixes,
+             'lengths': sorted(set(map(len, prefixes))),
+             'known': {}}
+
+    return index
+
+
+def classify_icd_code(code, index):
+    # bit mask of the lists matching one ICD code; results are memoized in the index
+
+    known = index['known']
+
+    if code not in known:
+        code_norm = normalize_icd(code)
+        mask = 0
+        for n in index['lengths']:
+            mask |= index['prefixes'].get(code_norm[:n], 0)
+        known[code] = mask
+
+    return known[code]
+
+
+# Classifying deaths
+# -----------------------------------------------------------------
+
+def classify_icd(icd, index):
+    # returns one boolean column per list, aligned with the Series 'icd'; missing codes match nothing
+
+    index_rows = getattr(icd, 'index', None)
+    icd = pd.Categorical(icd)
+
+    masks = [classify_icd_code(c, index) for c in icd.categories]
+    masks = np.array(masks + [0], dtype = 'int64') # code -1 (missing) picks the trailing 0
+
+    row_masks = masks[icd.codes]
+
+    flags = {name: (row_masks >> i) & 1 == 1 for i, name in enumerate(index['names'])}
+
+    return pd.DataFrame(flags, index = index_rows)
@@ -0,0 +1,102 @@
+#######################################################################################################
+#
+# Incremental consolidation state.
+#
+# The consolidated cube is kept on disk (cube.npy) next to a json file with, for each clean table,
+# a content hash of each year of it. On the next run only the years whose hash changed are
+# scattered again into the cube, and only those years of the final panel are rewritten.
+# A change in the panel's shape (municipalities, years, variables) or in the consolidation code
+# itself forces a full rebuild.
+#
+#######################################################################################################
+
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+# Hashes
+# -----------------------------------------------------------------
+
+def slice_hashes(df, by = 'year'):
+    # {year: hash of that year's rows}; row order within a year does not matter.
+    # Rows are hashed in one vectorized pass and each year's sorted row hashes are digested.
+
+    rows = pd.util.hash_pandas_object(df, index = False).to_numpy()
+    keys = df[by].to_numpy()
+
+    order = np.lexsort((rows, keys))
+    rows, keys = rows[order], keys[order]
+
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)]
+
+    hashes = {}
+    for start, end in zip(starts, ends):
+        digest = hashlib.sha256(rows[start:end].tobytes())
+        digest.update(','.join(df.columns).encode('utf-8'))
+        hashes[str(keys[start])] = digest.hexdigest()
+
+    return hashes
+
+
+def files_hash(files):
+    digest = hashlib.sha256()
+    for file in files:
+        with open(file, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def changed_slices(old, new):
+    # years (as int) that are new, removed or whose hash differs
+    keys = set(old) | set(new)
+    return sorted(int(k) for k in keys if old.get(k) != new.get(k))
+
+
+# Saved state
+# -----------------------------------------------------------------
+
+def state_files(folder):
+    return os.path.join(folder, 'cube.npy'), os.path.join(folder, 'state.json')
+
+
+def load_state(folder):
+    # (cube, state), or (None, None) if there is no previous run
+
+    file_cube, file_state = state_files(folder)
+
+    if not (os.path.exists(file_cube) and os.path.exists(file_state)):
+        return None, None
+
+    with open(file_state, 'r') as f:
+        state = json.load(f)
+
+    return np.load(file_cube), state
+
+
+def save_state(folder, cube, state):
+    # the state is written last (and should be saved after the final panel too), so a run that
+    # is interrupted leaves the previous hashes and its changes are redone on the next run
+
+    os.makedirs(folder, exist_ok = True)
+    file_cube, file_state = state_files(folder)
+
+    with open(file_cube + '.tmp', 'wb') as f:
+        np.save(f, cube)
+    os.replace(file_cube + '.tmp', file_cube)
+
+    with open(file_state + '.tmp', 'w') as f:
+        json.dump(state, f, indent = 1, sort_keys = True)
+    os.replace(file_state + '.tmp', file_state)
+
+
+def same_shape(state, index, variables, code):
+    return (state is not None
+            and state['mun_codes'] == index['mun_codes'].tolist()
+            and state['years'] == index['years'].tolist()
+            and state['variables'] == list(variables)
+            and state['code'] == code)
@@ -0,0 +1,120 @@
+#######################################################################################################
+#
+# Per-source, per-year partitions of the scraped data, with a manifest.
+#
+# Each (source, year) unit is written to its own csv as soon as it arrives, and the manifest
+# (manifest.json in the partitions folder) records its status, number of rows, content hash and
+# time-to-live. A re-run only fetches the units that are missing, failed, changed on disk or
+# expired, and the clean tables are rebuilt from the partitions.
+#
+#######################################################################################################
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+import pandas as pd
+
+
+manifest_lock = threading.Lock()
+
+
+# Files
+# -----------------------------------------------------------------
+
+def partition_file(folder, source, year):
+    return os.path.join(folder, source, str(year) + '.csv')
+
+
+def manifest_file(folder):
+    return os.path.join(folder, 'manifest.json')
+
+
+def file_hash(file):
+    with open(file, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# Manifest
+# -----------------------------------------------------------------
+
+def load_manifest(folder):
+    file = manifest_file(folder)
+
+    if not os.path.exists(file):
+        return {}
+
+    with open(file, 'r') as f:
+        return json.load(f)
+
+
+def update_manifest(folder, source, year, entry):
+    # read-modify-write under a lock, since partitions arrive from several threads
+
+    with manifest_lock:
+        manifest = load_manifest(folder)
+        manifest.setdefault(source, {})[str(year)] = entry
+
+        os.makedirs(folder, exist_ok = True)
+        file = manifest_file(folder)
+        with open(file + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent = 1, sort_keys = True)
+        os.replace(file + '.tmp', file)
+
+
+# Writing partitions
+# -----------------------------------------------------------------
+
+def write_partition(folder, source, year, df, ttl = None):
+    file = partition_file(folder, source, year)
+    os.makedirs(os.path.dirname(file), exist_ok = True)
+
+    df.to_csv(file + '.tmp', index = False)
+    os.replace(file + '.tmp', file)
+
+    entry = {'status': 'done',
+             'rows': len(df),
+             'hash': file_hash(file),
+             'updated_at': time.time(),
+             'ttl': ttl}
+
+    update_manifest(folder, source, year, entry)
+
+
+def mark_failed(folder, source, year, error):
+    entry = {'status': 'failed',
+             'error': str(error)[0:500],
+             'updated_at': time.time()}
+
+    update_manifest(folder, source, year, entry)
+
+
+# Finding what needs to be fetched
+# -----------------------------------------------------------------
+
+def is_fresh(folder, source, year, entry, now = None):
+    now = time.time() if now is None else now
+    file = partition_file(folder, source, year)
+
+    if entry is None or entry['status'] != 'done' or not os.path.exists(file):
+        return False
+
+    if entry['ttl'] is not None and now - entry['updated_at'] > entry['ttl']:
+        return False
+
+    return file_hash(file) == entry['hash']
+
+
+def pending_years(folder, source, years):
+    # years of 'source' that are missing, failed, changed on disk or expired
+    entries = load_manifest(folder).get(source, {})
+    return [year for year in years if not is_fresh(folder, source, year, entries.get(str(year)))]
+
+
+# Reading partitions
+# -----------------------------------------------------------------
+
+def read_partitions(folder, source, years):
+    return pd.concat([pd.read_csv(partition_file(folder, source, year)) for year in years], ignore_index = True)
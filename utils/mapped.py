@@ -0,0 +1,121 @@
+#######################################################################################################
+#
+# Memory-mapped binary copy of a table (the final panel), for fast loading.
+#
+# The file has a small header (magic, length and a JSON description of the columns) followed by
+# one fixed-width little-endian array per column, aligned to 64 bytes. Names (municipio, estado,
+# Region) are dictionary-encoded: the column holds integer codes (-1 if missing) and the distinct
+# names are kept in the header. Nullable integers (pop) have a byte mask next to their values.
+# Opening the file reads only the header; the columns are read-only numpy views of the mapped
+# file, so nothing is parsed or copied, and processes opening the same file share its pages.
+#
+#######################################################################################################
+
+import os
+import json
+import mmap
+import numpy as np
+import pandas as pd
+
+
+magic = b'PANEL\x00\x01\x00'
+alignment = 64
+
+
+def aligned(n):
+    return -(-n // alignment) * alignment
+
+
+def encode_column(s):
+    # (description, arrays) of a column: values, or codes, or values and mask
+    if isinstance(s.dtype, pd.CategoricalDtype) or s.dtype == object:
+        codes, categories = (s.cat.codes.to_numpy(), s.cat.categories) if isinstance(s.dtype, pd.CategoricalDtype) \
+                            else pd.factorize(s, sort = True)
+        codes = codes.astype('int16' if len(categories) < 2 ** 15 else 'int32')
+        return {'kind': 'dictionary', 'categories': [str(c) for c in categories]}, [codes]
+
+    if hasattr(s.dtype, 'numpy_dtype'): # nullable integer, float or boolean
+        values = s.to_numpy(dtype = s.dtype.numpy_dtype, na_value = 0)
+        return {'kind': 'masked', 'dtype': str(s.dtype)}, [values, s.isna().to_numpy().astype('uint8')]
+
+    return {'kind': 'values'}, [s.to_numpy()]
+
+
+def save_mapped(df, folder, name):
+    # writes df to folder/name.panel, atomically
+
+    file = os.path.join(folder, name + '.panel')
+
+    columns, arrays = [], []
+    for col in df.columns:
+        description, data = encode_column(df[col])
+        description['name'] = col
+        description['arrays'] = [{'dtype': a.dtype.newbyteorder('<').str} for a in data]
+        columns.append(description)
+        arrays.append([np.ascontiguousarray(a, dtype = a.dtype.newbyteorder('<')) for a in data])
+
+    # offsets depend on the header length, which depends on the offsets' digits: they are laid
+    # out after a header slot that is large enough for the final header
+    header_size = aligned(len(json.dumps({'rows': len(df), 'columns': columns})) + 64 * len(columns) + 1024)
+
+    offset = header_size
+    for description, data in zip(columns, arrays):
+        for meta, a in zip(description['arrays'], data):
+            meta['offset'] = offset
+            offset = aligned(offset + a.nbytes)
+
+    header = json.dumps({'rows': len(df), 'columns': columns}).encode('utf-8')
+    if len(header) + 16 > header_size:
+        raise ValueError('header too large')
+
+    with open(file + '.tmp', 'wb') as f:
+        f.write(magic + np.uint64(len(header)).tobytes() + header)
+        for description, data in zip(columns, arrays):
+            for meta, a in zip(description['arrays'], data):
+                f.seek(meta['offset'])
+                f.write(a.tobytes())
+        f.truncate(offset)
+
+    os.replace(file + '.tmp', file)
+
+
+def open_mapped(folder, name):
+    # dict with the number of rows and, by column, its description and its arrays (read-only
+    # views of the mapped file)
+
+    file = os.path.join(folder, name + '.panel')
+    with open(file, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) # stays open while views use it
+
+    if buffer[:8] != magic:
+        raise ValueError('not a mapped table: ' + file)
+
+    size = int(np.frombuffer(buffer, dtype = '<u8', count = 1, offset = 8)[0])
+    header = json.loads(buffer[16:16 + size].decode('utf-8'))
+    rows = header['rows']
+
+    columns = {}
+    for description in header['columns']:
+        views = [np.frombuffer(buffer, dtype = meta['dtype'], count = rows, offset = meta['offset'])
+                 for meta in description['arrays']]
+        columns[description['name']] = dict(description, views = views)
+
+    return {'rows': rows, 'columns': columns}
+
+
+def column_series(column):
+    # pandas column over the views: categoricals over the codes, masked arrays over values and mask
+    if column['kind'] == 'dictionary':
+        return pd.Categorical.from_codes(column['views'][0], categories = column['categories'])
+    if column['kind'] == 'masked':
+        values, mask = column['views']
+        return pd.api.types.pandas_dtype(column['dtype']).construct_array_type()(values, mask.view(bool))
+    return column['views'][0]
+
+
+def load_mapped(folder, name, columns = None):
+    # data frame of 'columns' (all if None) without copying numeric columns
+    table = open_mapped(folder, name)
+    columns = columns or list(table['columns'])
+
+    return pd.DataFrame({col: column_series(table['columns'][col]) for col in columns}, copy = False)
@@ -0,0 +1,158 @@
+#######################################################################################################
+#
+# Dense panel of municipalities x years x variables.
+#
+# Municipalities are mapped to rows once, through a direct-address lookup table over the 6-digit
+# codes (no hashing), and years to columns by offset from the first year. Each source table is
+# scattered into a preallocated (n_mun, n_years, n_vars) NumPy cube, so joining a source costs one
+# pass over its rows, and the cube is exported to the long data frame layout at the end.
+# Values of the previous year (e.g. births, as a rate denominator) are read along the year axis.
+# Sums over rolling windows of years come from prefix sums along the year axis: one cumulative
+# sum for all variables, then one subtraction per window length.
+#
+#######################################################################################################
+
+import numpy as np
+import pandas as pd
+
+
+n_codes = 10 ** 6 # 6-digit municipality codes
+
+
+# Index: municipality -> row, year -> column
+# -----------------------------------------------------------------
+
+def panel_index(mun_codes, years):
+    mun_codes = np.sort(np.asarray(mun_codes, dtype = 'int64'))
+    years = np.asarray(list(years), dtype = 'int64')
+
+    if not (np.diff(years) == 1).all():
+        raise ValueError('panel years must be consecutive')
+
+    lookup = np.full(n_codes, -1, dtype = 'int32')
+    lookup[mun_codes] = np.arange(len(mun_codes), dtype = 'int32')
+
+    return {'mun_codes': mun_codes, 'years': years, 'lookup': lookup}
+
+
+def locate(index, mun_code, year):
+    # rows and columns of (mun_code, year) pairs; 'valid' is False for pairs outside the panel
+
+    mun_code = np.asarray(mun_code, dtype = 'int64')
+    year = np.asarray(year, dtype = 'int64')
+
+    in_range = (mun_code >= 0) & (mun_code < n_codes)
+    row = np.full(len(mun_code), -1, dtype = 'int64')
+    row[in_range] = index['lookup'][mun_code[in_range]]
+
+    col = year - index['years'][0]
+
+    valid = (row >= 0) & (col >= 0) & (col < len(index['years']))
+
+    return row, col, valid
+
+
+# Cube
+# -----------------------------------------------------------------
+
+def new_cube(index, variables, fill = np.nan):
+    return np.full((len(index['mun_codes']), len(index['years']), len(variables)), fill, dtype = 'float64')
+
+
+def slots(variables, columns):
+    return np.array([variables.index(col) for col in columns])
+
+
+def scatter(cube, index, variables, df, columns):
+    # writes 'columns' of a table keyed by (mun_code, year) into the cube;
+    # rows outside the panel are ignored, as in a left merge on the panel
+
+    row, col, valid = locate(index, df['mun_code'], df['year'])
+    values = df[columns].to_numpy(dtype = 'float64')[valid]
+
+    cube[row[valid, None], col[valid, None], slots(variables, columns)[None, :]] = values
+
+
+def scatter_year(cube, index, variables, df, columns):
+    # writes 'columns' of a table keyed by year only to every municipality
+
+    col = df['year'].to_numpy(dtype = 'int64') - index['years'][0]
+    valid = (col >= 0) & (col < len(index['years']))
+
+    values = df[columns].to_numpy(dtype = 'float64')[valid]
+    cube[:, col[valid, None], slots(variables, columns)[None, :]] = values[None, :, :]
+
+
+def clear(cube, index, variables, columns, years, fill = np.nan):
+    # resets 'columns' for the given years, before they are scattered again
+    col = np.asarray(years, dtype = 'int64') - index['years'][0]
+    cube[:, col[:, None], slots(variables, columns)[None, :]] = fill
+
+
+def year_slice(cube, index, years):
+    # sub-cube and index of the given years
+    col = np.asarray(years, dtype = 'int64') - index['years'][0]
+    return cube[:, col, :], dict(index, years = index['years'][col])
+
+
+# Previous years
+# -----------------------------------------------------------------
+
+def previous_year(cube, index, variables, columns, years, lag = 1):
+    # values of 'columns' 'lag' years before each of 'years', taken along the year axis of the
+    # cube (so gaps between 'years' don't matter): a (n_mun, len(years), len(columns)) array, nan
+    # for years whose previous year is before the panel's first
+    col = np.asarray(years, dtype = 'int64') - index['years'][0] - lag
+
+    out = np.full((cube.shape[0], len(col), len(columns)), np.nan)
+    out[:, col >= 0, :] = cube[:, col[col >= 0, None], slots(variables, columns)[None, :]]
+    return out
+
+
+# Rolling windows
+# -----------------------------------------------------------------
+
+def prefix_sums(cube, variables, columns):
+    # cumulative sums of 'columns' along the years, with a leading zero year, and cumulative
+    # counts of their missing values: two (n_mun, n_years + 1, len(columns)) arrays
+    values = cube[:, :, slots(variables, columns)]
+    shape = (values.shape[0], values.shape[1] + 1, values.shape[2])
+
+    sums, missing = np.zeros(shape), np.zeros(shape)
+    np.cumsum(np.nan_to_num(values), axis = 1, out = sums[:, 1:, :])
+    np.cumsum(np.isnan(values), axis = 1, out = missing[:, 1:, :])
+    return sums, missing
+
+
+def window_sums(prefix, window):
+    # sums over the 'window' years ending at each year, from prefix_sums(); nan for the first
+    # window - 1 years, whose window is incomplete, and for windows with a missing value
+    sums, missing = prefix
+    n_years = sums.shape[1] - 1
+
+    out = np.full((sums.shape[0], n_years, sums.shape[2]), np.nan)
+    out[:, window - 1:, :] = sums[:, window:, :] - sums[:, :n_years - window + 1, :]
+    out[:, window - 1:, :][missing[:, window:, :] - missing[:, :n_years - window + 1, :] > 0] = np.nan
+    return out
+
+
+# Export
+# -----------------------------------------------------------------
+
+def cube_to_frame(cube, index, variables, ids = None):
+    # long layout, sorted by municipality and year: mun_code, year, [ids], variables;
+    # 'ids' holds municipality-level columns in the order of index['mun_codes']
+
+    n_mun = len(index['mun_codes'])
+    n_years = len(index['years'])
+
+    df = pd.DataFrame({'mun_code': np.repeat(index['mun_codes'], n_years),
+                       'year': np.tile(index['years'], n_mun)})
+
+    if ids is not None:
+        for col in ids.columns:
+            df[col] = np.repeat(ids[col].to_numpy(), n_years)
+
+    values = pd.DataFrame(cube.reshape(n_mun * n_years, len(variables)), columns = variables)
+
+    return pd.concat([df, values], axis = 1)
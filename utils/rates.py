@@ -0,0 +1,110 @@
+#######################################################################################################
+#
+# Rates of many numerators over one denominator.
+#
+# All numerator columns are taken as one 2-D array and divided by the denominator in a single
+# broadcasted, masked division (rows with a zero denominator get 'zero' instead of inf/nan), then
+# scaled, rounded and returned as one contiguous float32 block.
+#
+# Empirical-Bayes rates shrink each unit's rate toward the pooled rate of its group (e.g. its state
+# in the same year), the more so the fewer births it has (Poisson counts with Gamma-distributed
+# rates, method of moments as in Marshall, 1991). The group moments of all numerators are computed
+# together, with grouped sums (np.bincount on the group codes) in one pass over the rows.
+#
+#######################################################################################################
+
+import numpy as np
+import pandas as pd
+
+
+def compute_rates(df, numerators, denominator = 'births', scale = 1000, decimals = 2, zero = 0.0, suffix = '_rate'):
+    # 'denominator' is a column of df or an array aligned with its rows (e.g. the previous year's
+    # births, from utils/panel.py previous_year());
+    # returns a float32 data frame with one column per numerator, named numerator + suffix
+
+    num = df[numerators].to_numpy(dtype = 'float64', na_value = np.nan)
+
+    if isinstance(denominator, str):
+        den = df[denominator].to_numpy(dtype = 'float64', na_value = np.nan)
+    else:
+        den = np.asarray(denominator, dtype = 'float64')
+
+    den = den[:, None]
+    valid = den != 0 # nan denominators are kept and give nan rates
+
+    out = np.full(num.shape, zero, dtype = 'float64')
+    np.divide(num, den, out = out, where = valid)
+    np.multiply(out, scale, out = out, where = valid)
+
+    if decimals is not None:
+        np.round(out, decimals, out = out)
+
+    block = np.ascontiguousarray(out, dtype = 'float32')
+
+    return pd.DataFrame(block, columns = [v + suffix for v in numerators], index = df.index)
+
+
+def smoothed_rates(df, numerators, denominator = 'births', by = ('estado', 'year'), scale = 1000, decimals = 2, suffix = '_rate_eb'):
+    # empirical-Bayes rates of every numerator within the groups of the columns 'by', as a float32
+    # data frame with one column per numerator, named numerator + suffix. In each group, with r the
+    # raw rates, b the denominators, m the pooled rate sum(counts) / sum(b) and s2 the b-weighted
+    # variance of r around m, the prior variance is A = max(s2 - m / mean(b), 0) and each rate
+    # becomes m + A / (A + m / b) * (r - m). Rows with a zero denominator get m, rows with a
+    # missing one (or missing group) get nan.
+
+    # one row per numerator, so each numerator's values are contiguous
+    num = np.ascontiguousarray(df[numerators].to_numpy(dtype = 'float64', na_value = np.nan).T)
+    den = df[denominator].to_numpy(dtype = 'float64', na_value = np.nan)
+
+    # group codes from the codes of each key column; rows with a missing key or denominator
+    # are left out (-1)
+    g = np.zeros(len(df), dtype = 'int64')
+    for key in by:
+        codes, uniques = pd.factorize(df[key])
+        g = np.where((g < 0) | (codes < 0), -1, g * len(uniques) + codes)
+    g[np.isnan(den)] = -1
+    ok = g >= 0
+    g[ok] = pd.factorize(g[ok])[0]
+
+    # cells that inform the group moments: positive denominator and known count
+    valid = (den > 0) & (g >= 0) & ~np.isnan(num)
+    b = np.where(valid, den, 0.0)
+    d = np.where(valid, num, 0.0)
+    r = np.divide(d, b, out = np.zeros(num.shape), where = valid)
+
+    # all group sums in one pass over the rows: sums of b, d, d * r and the number of cells, by
+    # np.bincount on the group codes, for all numerators (sum(b (r - m)^2) = sum(d r) - m sum(d));
+    # rows without group go to an extra bin, dropped
+    G = g.max() + 1 if len(g) else 0
+    bins = np.where(g < 0, G, g)
+    B, D, DR, N = [np.array([np.bincount(bins, row, minlength = G + 1)[:G] for row in x])
+                   for x in (b, d, d * r, valid.astype('float64'))]
+
+    m = np.divide(D, B, out = np.zeros(B.shape), where = B > 0)
+    s2 = np.maximum(np.divide(DR, B, out = np.zeros(B.shape), where = B > 0) - m ** 2, 0.0)
+    mean_b = np.divide(B, N, out = np.zeros(B.shape), where = N > 0)
+    A = np.maximum(s2 - np.divide(m, mean_b, out = np.zeros(B.shape), where = mean_b > 0), 0.0)
+
+    # shrinkage factor of every cell, A / (A + m / b) = A b / (A b + m): 0 without births (the
+    # group rate), toward 1 with many; computed in place
+    mg = m[:, g]
+    Ab = A[:, g]
+    Ab *= b
+    total = Ab + mg
+    C = np.divide(Ab, total, out = Ab, where = total > 0)
+    C[total <= 0] = 0.0
+
+    out = r
+    out -= mg
+    out *= C
+    out += mg
+    out *= scale
+    out[:, g < 0] = np.nan
+    out[np.isnan(num)] = np.nan
+
+    if decimals is not None:
+        np.round(out, decimals, out = out)
+
+    block = np.ascontiguousarray(out.T, dtype = 'float32')
+
+    return pd.DataFrame(block, columns = [v + suffix for v in numerators], index = df.index)
@@ -0,0 +1,155 @@
+#######################################################################################################
+#
+# Adaptive rate control and retries for the DATASUS endpoints.
+#
+# For each host the scheduler keeps a concurrency limit that is adjusted AIMD-style: every request
+# that succeeds at normal speed raises the limit by 1/limit (about +1 per round of requests), while a
+# failure or a response much slower than the fastest seen halves it. Failed requests (connection
+# errors, timeouts, 429 and 5xx) are retried after an exponential backoff with jitter.
+# Every attempt is recorded, so per-request timings can be exported.
+#
+#######################################################################################################
+
+import time
+import random
+import threading
+
+import pandas as pd
+
+
+retry_status = (429, 500, 502, 503, 504)
+
+
+# Per-host state
+# -----------------------------------------------------------------
+
+class HostLimiter:
+
+    def __init__(self, host, start = 2, max_limit = 8, slow_factor = 3.0):
+        self.host = host
+        self.limit = float(start)
+        self.max_limit = max_limit
+        self.slow_factor = slow_factor
+
+        self.active = 0
+        self.min_latency = None
+        self.latency = None # moving average
+        self.error_rate = 0.0 # moving average
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, latency, ok):
+        with self.cond:
+            self.active -= 1
+
+            slow = False
+            if ok:
+                self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                slow = latency > self.slow_factor * self.min_latency
+
+            self.error_rate = 0.8 * self.error_rate + 0.2 * (0.0 if ok else 1.0)
+
+            # additive increase, multiplicative decrease
+            if ok and not slow:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            else:
+                self.limit = max(1.0, self.limit / 2.0)
+
+            self.cond.notify_all()
+
+
+# Scheduler
+# -----------------------------------------------------------------
+
+class Scheduler:
+
+    def __init__(self, max_per_host = 5, start = 2, retries = 4, backoff = 1.0, max_backoff = 60.0, slow_factor = 3.0):
+        self.max_per_host = max_per_host
+        self.start = min(start, max_per_host)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.slow_factor = slow_factor
+
+        self.hosts = {}
+        self.records = []
+        self.lock = threading.Lock()
+
+    def host(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostLimiter(host, start = self.start, max_limit = self.max_per_host, slow_factor = self.slow_factor)
+            return self.hosts[host]
+
+    def delay(self, attempt):
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def run(self, host, send, label = ''):
+        # calls send() (which returns a requests Response) under the host's concurrency limit,
+        # retrying failures; returns the response or raises the last error
+
+        limiter = self.host(host)
+
+        for attempt in range(self.retries + 1):
+            limiter.acquire()
+            t0 = time.time()
+            status = None
+            error = None
+
+            try:
+                response = send()
+                status = response.status_code
+            except Exception as e: # connection errors, timeouts
+                error = e
+
+            latency = time.time() - t0
+            ok = error is None and status < 400
+            limiter.release(latency, ok)
+
+            with self.lock:
+                self.records.append({'host': host,
+                                     'label': label,
+                                     'attempt': attempt,
+                                     'status': status,
+                                     'error': None if error is None else type(error).__name__,
+                                     'start': t0,
+                                     'latency': latency,
+                                     'limit': limiter.limit})
+
+            retry = error is not None or status in retry_status
+
+            if not retry:
+                return response
+
+            if attempt < self.retries:
+                time.sleep(self.delay(attempt))
+
+        if error is not None:
+            raise error
+        return response
+
+    # Timing stats
+    # ---------------------------
+
+    def stats(self):
+        # one row per attempt
+        with self.lock:
+            return pd.DataFrame(self.records, columns = ['host', 'label', 'attempt', 'status', 'error', 'start', 'latency', 'limit'])
+
+    def summary(self):
+        # one row per host
+        df = self.stats()
+        df['failed'] = df['error'].notna() | (df['status'] >= 400)
+
+        return df.groupby('host').agg(attempts = ('latency', 'size'),
+                                      failed = ('failed', 'sum'),
+                                      latency_mean = ('latency', 'mean'),
+                                      latency_p90 = ('latency', lambda x: x.quantile(0.9)),
+                                      limit_last = ('limit', 'last')).reset_index()
@@ -0,0 +1,330 @@
+#######################################################################################################
+#
+# Reading and aggregating SIM infant mortality micro data.
+#
+# The micro data is streamed straight out of the zip file in fixed-size chunks, so peak memory
+# depends on the chunk size and not on the size of the file. Nothing is extracted to disk.
+# In the parallel mode the csv is cut into blocks of whole lines, which are parsed and counted
+# by a pool of processes; the partial counts are added up exactly as in the serial mode.
+#
+# What is counted is declared in a spec of "cubes": each cube has grouping keys (municipality,
+# year, age group, sex, ...) and count measures (all deaths, deaths of an ICD chapter, deaths in
+# an ICD code list, ...). All cubes are counted in the same pass over the micro data. Within a chunk,
+# the keys of each death are packed into one integer and a cube is counted with a single bincount.
+#
+#######################################################################################################
+
+import io
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import ZipFile
+
+import numpy as np
+import pandas as pd
+
+from utils.icd import classify_icd
+
+
+# SIM columns used by the project and their names in the clean data
+# -----------------------------------------------------------------
+
+sim_columns = {'mun_res':'mun_code',
+               'ano':'year',
+               'capcid_cau':'icd_chapter',
+               'cid_cau':'icd'}
+
+sim_dtypes = {'mun_res':'Int32',
+              'ano':'Int16',
+              'capcid_cau':'category',
+              'cid_cau':'category'}
+
+
+# Causes of death: one row per variable in df_sim and the ICD chapter it counts
+# -----------------------------------------------------------------
+
+im_causes = {'im_perinat':'Perinatal period conditions',
+             'im_cong':'Congenital malformations',
+             'im_illdef':'Not well defined',
+             'im_infec':'Infectious and parasitic diseases',
+             'im_resp':'Respiratory system diseases',
+             'im_endoc':'Endocrine/nutrit./metabolic diseases',
+             'im_exter':'External causes',
+             'im_nerv':'Nervous system diseases',
+             'im_circ':'Circulatory system diseases',
+             'im_blood':'Blood diseases',
+             'im_digest':'Digestive system diseases',
+             'im_eye':'Eye/ear/skin/musculosk./genitourinary system',
+             'im_neop':'Neoplasms'}
+
+
+# Streaming reader
+# -----------------------------------------------------------------
+
+def read_sim_chunks(file, chunksize = 500000, columns = sim_columns, dtypes = sim_dtypes):
+    # yields the selected columns of the csv member inside the zip file, chunk by chunk
+
+    with ZipFile(file, 'r') as zipObj:
+        member = [f for f in zipObj.namelist() if f.lower().endswith('.csv')][0]
+
+        with zipObj.open(member) as f:
+            reader = pd.read_csv(f, chunksize = chunksize, **csv_options(columns, dtypes))
+
+            for chunk in reader:
+                yield chunk.rename(columns = columns)
+
+
+def read_sim_blocks(file, block_size = 64 * 2 ** 20):
+    # yields (header, block): the csv's header line and raw blocks of about 'block_size' bytes,
+    # cut at line ends (SIM fields have no line breaks inside quotes)
+
+    with ZipFile(file, 'r') as zipObj:
+        member = [f for f in zipObj.namelist() if f.lower().endswith('.csv')][0]
+
+        with zipObj.open(member) as f:
+            header = f.readline()
+            rest = b''
+
+            while True:
+                data = f.read(block_size)
+                if not data:
+                    break
+
+                data = rest + data
+                cut = data.rfind(b'\n') + 1
+
+                if cut > 0:
+                    yield header, data[:cut]
+                rest = data[cut:]
+
+            if rest.strip():
+                yield header, rest
+
+
+def parse_sim_block(header, block, columns = sim_columns, dtypes = sim_dtypes):
+    df = pd.read_csv(io.BytesIO(header + block), **csv_options(columns, dtypes))
+    return df.rename(columns = columns)
+
+
+def csv_options(columns, dtypes):
+    return {'sep': ',',
+            'encoding': 'latin1',
+            'usecols': list(columns),
+            'dtype': {col: dtype for col, dtype in dtypes.items() if col in columns}}
+
+
+# Spec of the cubes
+# -----------------------------------------------------------------
+
+# spec = {cube name: {'keys': [key, ...], 'measures': {measure name: condition, ...}}}
+#
+# a key is a column name, or a dict with a 'name' and a 'column' it is derived from, plus one of:
+#   'bins' (and optional 'labels', 'right'): intervals of a numeric column, as in pd.cut
+#   'map': a dict from the column's values to the key's values (values not in it are dropped)
+#
+# a measure condition is a dict, counting the deaths:
+#   {}: all deaths
+#   {'column': c, 'equals': v} or {'column': c, 'isin': [v, ...]}: with that value of column c
+#   {'icd_list': name}: whose ICD code is in the ICD list 'name' (utils/icd.py)
+#
+# deaths with a missing key are not counted in that cube
+
+def default_cube(causes = im_causes, icd_lists = ()):
+    # the municipality-year death counts of df_sim: all deaths ('im'), deaths by ICD chapter
+    # ('causes') and deaths in each ICD code list
+
+    measures = {'im': {}}
+    measures.update({var: {'column': 'icd_chapter', 'equals': chapter} for var, chapter in causes.items()})
+    measures.update({name: {'icd_list': name} for name in icd_lists})
+
+    return {'keys': ['mun_code', 'year'], 'measures': measures}
+
+
+# Counting a cube
+# -----------------------------------------------------------------
+
+def encode_key(df, key):
+    # (name, codes, values): the code of each death into the sorted distinct 'values' of the key;
+    # deaths with a missing key get -1
+
+    if isinstance(key, str):
+        return (key,) + encode_values(df[key])
+
+    values = df[key['column']]
+
+    if 'bins' in key:
+        values = pd.cut(values, bins = key['bins'], labels = key.get('labels'), right = key.get('right', True))
+    elif 'map' in key:
+        values = values.map(key['map'])
+
+    return (key['name'],) + encode_values(values)
+
+
+def encode_values(values):
+    codes, uniques = pd.factorize(values, sort = True)
+    return codes.astype('int64'), uniques
+
+
+def measure_mask(condition, flags):
+    # deaths counted by an ICD list measure, as a boolean array (None for all deaths)
+    if 'icd_list' in condition:
+        return np.asarray(flags[condition['icd_list']])
+    return None
+
+
+def column_lookups(values, conditions):
+    # the 'equals'/'isin' measures on one column, [(i, condition), ...]: the column's values coded
+    # once (its category codes, as the ICD chapter comes, else pd.factorize) and lookup tables from a code to the measure i that counts it (-1 for
+    # none, also in the extra last entry, where missing values' code -1 lands). Measures that
+    # share a value go to separate tables; disjoint ones (e.g. the ICD chapters) share one.
+
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), pd.Index(values.cat.categories)
+    else:
+        codes, uniques = pd.factorize(values)
+        uniques = pd.Index(uniques)
+
+    lookups = []
+    for i, condition in conditions:
+        targets = [condition['equals']] if 'equals' in condition else list(condition['isin'])
+        position = uniques.get_indexer(targets)
+        position = position[position >= 0]
+
+        for lookup in lookups:
+            if (lookup[position] < 0).all():
+                break
+        else:
+            lookup = np.full(len(uniques) + 1, -1, dtype = 'int64')
+            lookups.append(lookup)
+        lookup[position] = i
+
+    return codes, lookups
+
+
+def count_cube(df, keys, measures, flags = None):
+    # counts of each measure by the cube's keys, for the combinations of keys present in df
+
+    encoded = [encode_key(df, key) for key in keys]
+    names = [name for name, _, _ in encoded]
+    shape = [len(values) for _, _, values in encoded]
+
+    # keys packed into one integer, in key order (so the packed keys sort like the key tuples)
+    packed = np.zeros(len(df), dtype = 'int64')
+    valid = np.ones(len(df), dtype = bool)
+    for (_, codes, _), size in zip(encoded, shape):
+        packed = packed * size + codes
+        valid &= codes >= 0
+
+    # a domain much larger than the number of deaths is compacted to the cells present
+    cells = packed[valid]
+    n_cells = int(np.prod(shape, dtype = 'int64'))
+
+    if n_cells > 4 * len(df) + 1024:
+        group, present = pd.factorize(cells, sort = True)
+        n_cells = len(present)
+    else:
+        group, present = cells, None
+
+    # slot 0 counts every death (it tells which cells are present), slot 1 + i counts measure i:
+    # the slots of all measures are concatenated and counted with one bincount
+    conditions = list(measures.values())
+    n_slots = len(conditions) + 1
+
+    slots = [group * n_slots]
+    by_column = {}
+    for i, condition in enumerate(conditions):
+        if 'column' in condition:
+            by_column.setdefault(condition['column'], []).append((i, condition))
+            continue
+        mask = measure_mask(condition, flags)
+        slots.append(group * n_slots + (i + 1) if mask is None else group[mask[valid]] * n_slots + (i + 1))
+
+    # the measures on a column get their slots in one pass over its codes, whatever their number
+    for column, column_conditions in by_column.items():
+        codes, lookups = column_lookups(df[column], column_conditions)
+        codes = codes[valid]
+        for lookup in lookups:
+            measure = lookup[codes]
+            counted = measure >= 0
+            slots.append(group[counted] * n_slots + measure[counted] + 1)
+
+    counts = np.bincount(np.concatenate(slots), minlength = n_cells * n_slots).reshape(n_cells, n_slots)
+
+    cell = np.flatnonzero(counts[:, 0])
+    packed_cell = cell if present is None else present[cell]
+
+    codes = np.unravel_index(packed_cell, shape)
+    index = pd.MultiIndex.from_arrays([values.take(c) for (_, _, values), c in zip(encoded, codes)], names = names)
+
+    return pd.DataFrame(counts[cell, 1:], index = index, columns = list(measures))
+
+
+def collapse_sim(df, spec, icd_index = None):
+    # counts of one chunk for every cube of the spec: {cube name: counts}
+    flags = None if icd_index is None else classify_icd(df['icd'], icd_index)
+    return {name: count_cube(df, cube['keys'], cube['measures'], flags) for name, cube in spec.items()}
+
+
+# Running aggregation
+# -----------------------------------------------------------------
+
+def merge_counts(partials):
+    # adds up the counts of each cube over the chunks; a cube's running total is bounded by its number
+    # of cells. Counts are whole numbers, so the order of the additions doesn't matter
+
+    cubes = {}
+
+    for partial in partials:
+        for name, counts in partial.items():
+            if name not in cubes:
+                cubes[name] = counts
+            else:
+                cubes[name] = cubes[name].add(counts, fill_value = 0)
+
+    for name, df in cubes.items():
+        keys = list(df.index.names)
+        df = df.astype('int64').sort_index().reset_index()
+
+        # integer keys (municipality codes, years) come back as nullable integers
+        for col in keys:
+            if pd.api.types.is_integer_dtype(df[col]):
+                df[col] = df[col].astype('int64')
+
+        cubes[name] = df
+
+    return cubes
+
+
+def aggregate_sim(chunks, collapse):
+    # 'collapse' turns one chunk into {cube name: counts indexed by the cube's keys}
+    return merge_counts(collapse(chunk) for chunk in chunks)
+
+
+# Parallel aggregation
+# -----------------------------------------------------------------
+
+def collapse_block(collapse, header, block, columns, dtypes):
+    return collapse(parse_sim_block(header, block, columns, dtypes))
+
+
+def aggregate_sim_parallel(file, collapse, workers = None, block_size = 64 * 2 ** 20, columns = sim_columns, dtypes = sim_dtypes):
+    # same result as aggregate_sim(read_sim_chunks(file), collapse), with the blocks parsed and
+    # counted in 'workers' processes (all cores if None). 'collapse' is sent to the workers, so it
+    # must be picklable (a module-level function or a functools.partial of one). At most two
+    # blocks per worker are in flight, which bounds memory.
+
+    workers = workers or multiprocessing.cpu_count()
+    context = multiprocessing.get_context('spawn') # safe when called from a multi-threaded process
+
+    with ProcessPoolExecutor(max_workers = workers, mp_context = context) as executor:
+
+        def partials():
+            pending = deque()
+            for header, block in read_sim_blocks(file, block_size = block_size):
+                pending.append(executor.submit(collapse_block, collapse, header, block, columns, dtypes))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+        return merge_counts(partials())
@@ -0,0 +1,173 @@
+#######################################################################################################
+#
+# Typed columnar storage for the clean tables and the final panel.
+#
+# Tables are saved as compressed Parquet files (needs pyarrow) with an explicit schema, so the next
+# script gets int32 codes, int16 years, small unsigned counts, float32 rates and categorical
+# names back without re-parsing text, and can load only the columns it needs.
+# A csv copy can still be written next to it. Tables that are updated in parts (the final panel,
+# by year) are saved as a folder with one Parquet file per part and read back as one table.
+# Tables derived from another one can be cached and rebuilt only when the source's content or
+# the code that builds them changes.
+#
+#######################################################################################################
+
+import os
+import re
+import json
+import numpy as np
+import pandas as pd
+
+from utils.dag import path_hash
+
+
+# Schema
+# -----------------------------------------------------------------
+
+# key columns of the panel tables
+key_columns = ['mun_code', 'year']
+
+# (column name pattern, dtype): the first matching pattern gives the column's type;
+# columns that match none are saved as they are; integer types are the narrowest used, and are
+# widened when a column's values don't fit
+
+schema = [(r'^mun_code$', 'int32'),
+          (r'^year$', 'int16'),
+          (r'^im.*_rate$', 'float32'),
+          (r'^im.*_rate_(eb|prev|\d+y)$', 'float32'), # smoothed, previous births and pooled rates
+          (r'^im', 'uint16'),            # deaths by municipality-year (wider if larger: fitted_dtype)
+          (r'^births$', 'uint32'),
+          (r'^pop$', 'UInt32'),          # missing for some municipality-years
+          (r'^pc_spend$', 'float32'),
+          (r'^index$', 'float64'),
+          (r'^(Region|estado|municipio)$', 'category')]
+
+
+def column_dtype(col):
+    for pattern, dtype in schema:
+        if re.search(pattern, col):
+            return dtype
+    return None
+
+
+def fitted_dtype(s, dtype):
+    # integer 'dtype' widened, if needed, to hold every value of s: the schema's widths are the
+    # usual ones (deaths of a municipality-year fit uint16), but a table keyed by year only (e.g.
+    # a SIM cube of Brazil) has larger counts, which astype() would wrap around silently
+
+    values = s.dropna()
+    if not len(values):
+        return dtype
+
+    low, high = int(values.min()), int(values.max())
+    limits = np.iinfo(dtype.lower())
+    if limits.min <= low and high <= limits.max:
+        return dtype
+
+    nullable = dtype[0] in 'IU'
+    fit = np.result_type(np.min_scalar_type(low), np.min_scalar_type(high))
+    if fit.kind not in 'iu':
+        raise ValueError('column ' + str(s.name) + ' does not fit in any integer type')
+
+    return fit.name.replace('uint', 'UInt').replace('int', 'Int') if nullable else fit.name
+
+
+def apply_schema(df):
+    dtypes = {col: column_dtype(col) for col in df.columns}
+    dtypes = {col: dtype for col, dtype in dtypes.items() if dtype is not None}
+
+    for col, dtype in dtypes.items():
+        if dtype[0] in 'iuIU':
+            # integer columns may come as float (e.g. after a merge); they are whole numbers by then
+            if df[col].dtype.kind == 'f':
+                df = df.assign(**{col: df[col].round()})
+            dtypes[col] = fitted_dtype(df[col], dtype)
+
+    return df.astype(dtypes)
+
+
+# Saving and loading
+# -----------------------------------------------------------------
+
+def table_file(folder, name, ext = '.parquet'):
+    return os.path.join(folder, name + ext)
+
+
+def save_table(df, folder, name, csv = False):
+    df = apply_schema(df)
+    df.to_parquet(table_file(folder, name), index = False, compression = 'zstd')
+
+    if csv:
+        df.to_csv(table_file(folder, name, '.csv'), index = False)
+
+
+def save_table_part(df, folder, name, part):
+    # one part of a partitioned table (e.g. one year of the final panel), in folder/name/part.parquet
+    file = table_file(os.path.join(folder, name), str(part))
+    os.makedirs(os.path.dirname(file), exist_ok = True)
+
+    apply_schema(df).to_parquet(file + '.tmp', index = False, compression = 'zstd')
+    os.replace(file + '.tmp', file)
+
+
+def load_parts(folder, name, columns = None):
+    # all parts of a partitioned table, back in (mun_code, year) order
+
+    part_folder = os.path.join(folder, name)
+    parts = sorted(f for f in os.listdir(part_folder) if f.endswith('.parquet'))
+
+    df = pd.concat([pd.read_parquet(os.path.join(part_folder, f), columns = columns) for f in parts], ignore_index = True)
+
+    keys = [col for col in key_columns if col in df.columns]
+    if keys:
+        df = df.sort_values(keys, kind = 'stable').reset_index(drop = True)
+
+    return apply_schema(df) # categories may differ between parts
+
+
+def load_table(folder, name, columns = None):
+    # reads only 'columns' (all if None), from a partitioned table, a single parquet file or,
+    # if there is no parquet file yet, the csv
+
+    if os.path.isdir(os.path.join(folder, name)):
+        return load_parts(folder, name, columns)
+
+    file = table_file(folder, name)
+
+    if os.path.exists(file):
+        return pd.read_parquet(file, columns = columns)
+
+    df = pd.read_csv(table_file(folder, name, '.csv'), usecols = columns)
+    return apply_schema(df)
+
+
+# Cached derived tables
+# -----------------------------------------------------------------
+
+def cached_table(folder, name, source, build, code = ()):
+    # the table 'name', rebuilt with build() and saved only when the content hash of 'source'
+    # (a file or folder) or of the 'code' files that build it differs from the ones it was last
+    # built with; the hashes are kept in folder/name.json, with the size and time of the files so
+    # unchanged files aren't re-read
+
+    meta_file = table_file(folder, name, '.json')
+
+    meta = {'source': None, 'code': None, 'files': {}}
+    if os.path.exists(meta_file):
+        with open(meta_file, 'r') as f:
+            meta.update(json.load(f))
+
+    source_hash = path_hash(source, meta['files'])
+    code_hash = [path_hash(file, meta['files']) for file in code]
+
+    if source_hash is not None and source_hash == meta['source'] and code_hash == meta['code'] \
+       and os.path.exists(table_file(folder, name)):
+        return load_table(folder, name)
+
+    save_table(build(), folder, name)
+
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump({'source': source_hash, 'code': code_hash, 'files': meta['files']}, f, indent = 1)
+    os.replace(meta_file + '.tmp', meta_file)
+
+    return load_table(folder, name)
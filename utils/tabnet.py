@@ -0,0 +1,150 @@
+#######################################################################################################
+#
+# Parsing TabNet/SIOPS HTML tables.
+#
+# The response is fed to lxml's incremental (pull) parser and handled one table row at a time;
+# rows are freed as soon as they are read, so the full tree is never built. Rows whose first cell
+# starts with a 6-digit municipality code are data rows, so the 'Total' row, header and footer
+# cells are left out without slicing them off by hand.
+#
+#######################################################################################################
+
+import re
+import numpy as np
+import pandas as pd
+from lxml import etree
+
+
+mun_row = re.compile(r'^(\d{6})\s*(.*)$', re.S)
+
+
+# Brazilian number format
+# -----------------------------------------------------------------
+
+def parse_br_numbers(values):
+    # '1.234.567,89' -> 1234567.89 ; anything else ('-', '...', '') -> NaN
+    values = pd.Series(values, dtype = 'object')
+    values = values.str.replace('.', '', regex = False).str.replace(',', '.', regex = False)
+    return pd.to_numeric(values, errors = 'coerce')
+
+
+# Table parser
+# -----------------------------------------------------------------
+
+def row_cells(row):
+    return [(cell.tag, ''.join(cell.itertext()).strip()) for cell in row if cell.tag in ('td', 'th')]
+
+
+def iter_rows(html, chunk_size = 65536):
+    # yields the (tag, text) of the cells of each table row
+
+    if isinstance(html, str):
+        html = html.encode('utf-8')
+        parser = etree.HTMLPullParser(events = ('end',), tag = 'tr', encoding = 'utf-8')
+    else:
+        parser = etree.HTMLPullParser(events = ('end',), tag = 'tr')
+
+    for i in range(0, len(html), chunk_size):
+        parser.feed(html[i:i + chunk_size])
+
+        for _, row in parser.read_events():
+            yield row_cells(row)
+
+            # freeing the row and any row already read before it
+            row.clear()
+            while row.getprevious() is not None:
+                del row.getparent()[0]
+
+    parser.close()
+
+    for _, row in parser.read_events():
+        yield row_cells(row)
+
+
+def parse_tabnet(html):
+    # returns one row per municipality with columns 'code' (int), 'name' and one numeric column per
+    # value column of the table, named after the table header (e.g. '2000', 'Total')
+
+    header = None
+    codes = []
+    names = []
+    values = []
+
+    for cells in iter_rows(html):
+        if len(cells) == 0:
+            continue
+
+        texts = [text for _, text in cells]
+        match = mun_row.match(texts[0])
+
+        if match:
+            codes.append(match.group(1))
+            names.append(match.group(2).strip())
+            values.append(texts[1:])
+
+        # header: the last row made only of th cells before the first municipality
+        elif len(codes) == 0 and len(cells) > 1 and all(tag == 'th' for tag, _ in cells):
+            header = texts
+
+    n_values = max(map(len, values)) if values else 0
+
+    if header is not None and len(header) - 1 == n_values:
+        value_cols = header[1:]
+    else:
+        value_cols = ['value_' + str(i) for i in range(n_values)]
+
+    df = pd.DataFrame({'code': np.array(codes, dtype = 'int64'),
+                       'name': names})
+
+    # all value cells as one flat array, converted in a single vectorized pass
+    cells = [row + [''] * (n_values - len(row)) for row in values]
+    cells = parse_br_numbers(np.array(cells, dtype = 'object').ravel()).to_numpy()
+    cells = cells.reshape(len(codes), n_values)
+
+    for i, col in enumerate(value_cols):
+        df[col] = cells[:, i]
+
+    return df
+
+
+# Query builder
+# -----------------------------------------------------------------
+
+# TabNet takes repeated 'Incremento' (indicators) and 'Arquivos' (one .dbf file per year) fields.
+# With the years as the table column, one request returns a wide table with one column per year,
+# which 'tabnet_long' turns back into the long (year, mun_code, value) layout.
+
+def tabnet_query(linha, coluna, incrementos, arquivos, filters):
+    # all arguments are already url-encoded the way TabNet expects (latin1)
+
+    fields = [('Linha', linha), ('Coluna', coluna)]
+    fields += [('Incremento', i) for i in incrementos]
+    fields += [('Arquivos', a) for a in arquivos]
+
+    return '&'.join(k + '=' + v for k, v in fields) + '&' + filters
+
+
+def batch_years(years, years_per_request):
+    years = list(years)
+    return [years[i:i + years_per_request] for i in range(0, len(years), years_per_request)]
+
+
+def tabnet_long(df, var, years):
+    # wide table from 'parse_tabnet' (one column per year) -> long table (year, mun_code, var);
+    # empty cells ('-') are municipalities without records that year and are left out,
+    # as they would be in a table for that single year
+
+    missing = [year for year in years if str(year) not in df.columns]
+    if len(missing) > 0:
+        raise ValueError('years not found in the TabNet table: ' + str(missing))
+
+    df_long = df.melt(id_vars = ['code'],
+                      value_vars = [str(year) for year in years],
+                      var_name = 'year',
+                      value_name = var)
+
+    df_long = df_long.dropna(subset = [var])
+    df_long['year'] = df_long['year'].astype(int)
+    df_long = df_long.rename(columns = {'code': 'mun_code'})
+
+    return df_long.filter(['year', 'mun_code', var]).reset_index(drop = True)